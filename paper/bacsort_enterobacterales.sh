@@ -18,7 +18,7 @@ mv GCF_001461805.1_ASM146180v1_genomic.fna.gz assemblies/Enterobacter/GCF_001461
 cd assemblies/Enterobacter
 echo "GCF_000164865.1\tPRJNA224116\tSAMN00116754\t\t\trepresentative genome\tassembly from type material\t701347\t1334193\tEnterobacter lignolyticus SCF1\tstrain=SCF1\t\tlatest\tComplete Genome\tMajor\tFull\t2010/10/15\tASM16486v1\tUS DOE Joint Genome Institute\tGCA_000164865.1\tidentical\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/000/164/865/GCF_000164865.1_ASM16486v1\t./refseq/bacteria/GCF_000164865.1/GCF_000164865.1_ASM16486v1_genomic.fna.gz" >> data.tsv
 echo "GCF_001461805.1\tPRJNA224116\tSAMN04074888\t\t\tna\t\t1334193\t1334193\tEnterobacter lignolyticus\tstrain=G5\t\tlatest\tComplete Genome\tMajor\tFull\t2015/12/07\tASM146180v1\tUniversity of Malaya\tGCA_001461805.1\tidentical\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/001/461/805/GCF_001461805.1_ASM146180v1\t./refseq/bacteria/GCF_001461805.1/GCF_001461805.1_ASM146180v1_genomic.fna.gz" >> data.tsv
-rm mash_distances mash.msh
+rm mash_distances mash.msh clustering_state.tsv
 mash sketch -p 16 -o mash -s 10000 *.fna.gz
 mash dist -p 16 mash.msh mash.msh > mash_distances
 cd ../..
@@ -18,12 +18,17 @@ not, see <http://www.gnu.org/licenses/>.
 
 import pathlib
 import os
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'scripts'))
+from species_index import load_ncbi_organism_names, load_species_definitions
 
 
 def main():
     cluster_accessions = load_all_cluster_accessions()
-    accession_species_before = load_accession_species(False)
-    accession_species_after = load_accession_species(True)
+    accession_species_before = load_ncbi_organism_names()
+    accession_species_after = dict(accession_species_before)
+    accession_species_after.update(load_species_definitions())
     cluster_files = sorted(str(x) for x in pathlib.Path.cwd().glob('clusters/*.fna.gz'))
     total_count = 0
     for cluster_file in cluster_files:
@@ -118,37 +123,5 @@ def load_all_cluster_accessions():
     return cluster_accessions
 
 
-def load_accession_species(use_species_definitions_file):
-    accession_species = {}
-
-    # Load from NCBI metadata first...
-    data_files = [str(x) for x in pathlib.Path.cwd().glob('assemblies/*/data.tsv')]
-    for data_file in data_files:
-        with open(data_file, 'rt') as data:
-            for line in data:
-                parts = line.split('\t')
-                if parts[0] == 'assembly_accession':
-                    continue
-                accession = parts[0][:13]
-                species = parts[9]
-                accession_species[accession] = species
-
-    # ...and then load from the user-defined file, so they can overwrite NCBI species.
-    if use_species_definitions_file and pathlib.Path('species_definitions').is_file():
-        with open('species_definitions', 'rt') as user_species:
-            for line in user_species:
-                if not line.startswith('GCF'):
-                    continue
-                parts = line.strip().split('\t')
-                if parts[0] == 'Accession':
-                    continue
-                if len(parts) < 2:
-                    continue
-                accession, species = parts[0][:13], parts[1]
-                accession_species[accession] = species
-
-    return accession_species
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,194 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module manages a persistent SQLite store of FastANI results, so FastANI only needs to be run
+for pairs of clusters which haven't been compared before. Results are keyed by a hash of each
+cluster representative's file contents (not the cluster name), so they stay valid when clusters
+are renumbered and become invalid if a cluster's representative changes.
+
+Every computed pair is recorded, including pairs where FastANI reported nothing (ANI too low),
+which are stored with a NULL ANI.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+
+# Many FastANI jobs may add to the store at once, so writers wait (up to this many seconds) for
+# the database lock instead of failing.
+LOCK_TIMEOUT = 3600
+
+
+def open_ani_store(store_filename):
+    connection = sqlite3.connect(store_filename, timeout=LOCK_TIMEOUT)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS assemblies (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            assembly_id INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS ani (
+            query_id INTEGER NOT NULL,
+            reference_id INTEGER NOT NULL,
+            ani REAL,
+            PRIMARY KEY (query_id, reference_id)) WITHOUT ROWID;
+    ''')
+    return connection
+
+
+def get_assembly_ids(connection, paths):
+    """
+    Returns a dictionary of path to assembly ID. Files are only hashed if they are new or their
+    size/modification time has changed since they were last hashed.
+    """
+    assembly_ids = {}
+    with connection:
+        for path in paths:
+            file_stat = os.stat(path)
+            abs_path = os.path.abspath(path)
+            row = connection.execute('SELECT size, mtime, assembly_id FROM files WHERE path = ?',
+                                     (abs_path,)).fetchone()
+            if row is not None and row[0] == file_stat.st_size and \
+                    row[1] == file_stat.st_mtime_ns:
+                assembly_ids[path] = row[2]
+                continue
+            file_hash = get_file_hash(path)
+            connection.execute('INSERT OR IGNORE INTO assemblies (hash) VALUES (?)', (file_hash,))
+            assembly_id = connection.execute('SELECT id FROM assemblies WHERE hash = ?',
+                                             (file_hash,)).fetchone()[0]
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                               (abs_path, file_stat.st_size, file_stat.st_mtime_ns, assembly_id))
+            assembly_ids[path] = assembly_id
+    return assembly_ids
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def add_fastani_results(connection, query_ids, reference_ids, fastani_lines):
+    """
+    Records every query/reference pair as computed, with the ANI from the FastANI output lines
+    (or NULL for pairs FastANI didn't report). The ID dictionaries map the names used in the
+    FastANI output to assembly IDs.
+    """
+    anis = {}
+    for line in fastani_lines:
+        parts = line.split()
+        if len(parts) < 3:
+            continue
+        anis[(query_ids[parts[0]], reference_ids[parts[1]])] = float(parts[2])
+    rows = ((q, r, anis.get((q, r))) for q in set(query_ids.values())
+            for r in set(reference_ids.values()))
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO ani VALUES (?, ?, ?)', rows)
+
+
+def get_incomplete_ids(connection, assembly_ids, reciprocal=False):
+    """
+    Returns a set of 'new' assembly IDs such that every pair of the remaining ('old') assemblies
+    has a stored result (including each assembly with itself). If reciprocal is set, results are
+    needed in both directions, otherwise either direction will do. Comparing the new assemblies
+    to everything, and the old assemblies to the new ones, then fills in all gaps.
+
+    This is done by repeatedly moving the assemblies with the most missing results to the new
+    set. Usually that happens once: never-seen assemblies are missing everything.
+    """
+    old_ids = set(assembly_ids)
+    while old_ids:
+        missing_counts = get_missing_counts(connection, old_ids, reciprocal)
+        most_missing = max(missing_counts.values())
+        if most_missing == 0:
+            break
+        old_ids -= set(i for i, count in missing_counts.items() if count == most_missing)
+    return set(assembly_ids) - old_ids
+
+
+def get_missing_counts(connection, assembly_ids, reciprocal):
+    """
+    Returns a dictionary of assembly ID to the number of results it lacks with the given
+    assemblies: counting each direction separately if reciprocal is set, otherwise counting
+    partners with a result in either direction.
+    """
+    set_current_ids(connection, assembly_ids)
+    if not reciprocal:
+        missing_counts = {i: len(assembly_ids) for i in assembly_ids}
+        for assembly_id, count in connection.execute(
+                'SELECT a, COUNT(DISTINCT b) FROM '
+                '(SELECT query_id AS a, reference_id AS b FROM ani '
+                'UNION ALL SELECT reference_id, query_id FROM ani) '
+                'JOIN current AS c1 ON a = c1.id '
+                'JOIN current AS c2 ON b = c2.id '
+                'GROUP BY a'):
+            missing_counts[assembly_id] -= count
+        return missing_counts
+    missing_counts = {i: 2 * len(assembly_ids) for i in assembly_ids}
+    for column, other_column in (('query_id', 'reference_id'), ('reference_id', 'query_id')):
+        for assembly_id, count in connection.execute(
+                'SELECT ani.{0}, COUNT(*) FROM ani '
+                'JOIN current AS c1 ON ani.{0} = c1.id '
+                'JOIN current AS c2 ON ani.{1} = c2.id '
+                'GROUP BY ani.{0}'.format(column, other_column)):
+            missing_counts[assembly_id] -= count
+    return missing_counts
+
+
+def get_missing_pairs(connection, assembly_ids, required_pairs, reciprocal=False):
+    """
+    Returns the required pairs (as (ID, ID) tuples) which don't have a stored result: in both
+    directions if reciprocal is set, otherwise in either direction.
+    """
+    set_current_ids(connection, assembly_ids)
+    stored = set(connection.execute('SELECT query_id, reference_id FROM ani '
+                                    'JOIN current AS c1 ON ani.query_id = c1.id '
+                                    'JOIN current AS c2 ON ani.reference_id = c2.id'))
+    if reciprocal:
+        return [(a, b) for a, b in required_pairs
+                if (a, b) not in stored or (b, a) not in stored]
+    else:
+        return [(a, b) for a, b in required_pairs
+                if (a, b) not in stored and (b, a) not in stored]
+
+
+def set_current_ids(connection, assembly_ids):
+    """
+    Puts the given IDs in a temporary table, for joining against the results.
+    """
+    with connection:
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS current (id INTEGER PRIMARY KEY)')
+        connection.execute('DELETE FROM current')
+        connection.executemany('INSERT INTO current VALUES (?)', ((i,) for i in assembly_ids))
+
+
+def get_ani_results(connection, assembly_names):
+    """
+    Yields (query name, reference name, ANI) for all stored results between the given
+    assemblies (a dictionary of assembly ID to name). Pairs with no ANI are skipped.
+    """
+    set_current_ids(connection, assembly_names)
+    cursor = connection.execute('SELECT query_id, reference_id, ani FROM ani '
+                                'JOIN current AS c1 ON ani.query_id = c1.id '
+                                'JOIN current AS c2 ON ani.reference_id = c2.id '
+                                'WHERE ani IS NOT NULL')
+    for query_id, reference_id, ani in cursor:
+        yield assembly_names[query_id], assembly_names[reference_id], ani
@@ -12,6 +12,40 @@ copy_assemblies.py or copy_clusters.py script:
 Then you can use this script like so:
     classify_assembly_using_mash.py sketches.msh query.fasta
 
+Alternatively, the reference can be a sketch file made by sketch_assemblies.py (ending in .npz),
+in which case the query is sketched and compared in-process, without Mash:
+    sketch_assemblies.py --out sketches.npz */*/*.fna.gz
+    classify_assembly_using_mash.py sketches.npz query.fasta
+
+Loading a large reference can take most of the time for each query, so with an .npz reference
+this script can also run as a server (--serve) which loads the reference once and then answers
+classification requests (concurrently) over HTTP, on either a local port or a Unix socket:
+    classify_assembly_using_mash.py --serve 8000 sketches.npz
+    curl 'http://localhost:8000/classify?input=/path/to/query.fasta'
+    curl -G http://localhost:8000/classify \\
+        -d input=/path/to/reads_1.fastq.gz -d input=/path/to/reads_2.fastq.gz
+The response is the same tab-delimited line this script prints. Input paths are read by the
+server, so they must be absolute (or relative to the server's directory).
+
+Many samples can be classified in one run by giving a manifest instead of input files: a
+tab-delimited file with a sample name followed by one or more FASTA/FASTQ paths on each line.
+One result line is printed per sample, as soon as it finishes (so not necessarily in manifest
+order). With an .npz reference, the reference is loaded once and the samples are sketched in
+parallel (--threads):
+    classify_assembly_using_mash.py --manifest samples.tsv sketches.npz
+
+By default, only the closest match within --threshold is reported. To help with samples near
+species boundaries, --top reports the closest k references (one line each: sample, rank,
+species, identity, reference) and --species_summary reports each species' best and median
+identity (one line each: sample, species, best identity, median identity, reference count,
+closest species first). These reports ignore --threshold.
+
+With an .npz reference, --screen classifies by containment instead (like mash screen), which
+suits deep read sets: the reads are streamed once against an index of the reference hashes,
+without sketching them, and each reference's identity is estimated from the fraction of its
+sketch found in the reads. Reading stops early once the best species is within --threshold and
+ahead of every other species by --screen_margin.
+
 This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 under the terms of the GNU General Public License as published by the Free Software Foundation,
 either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
@@ -22,11 +56,27 @@ not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-import subprocess
+import collections
+import concurrent.futures
+import contextlib
+import http.server
+import os
 import pathlib
+import shutil
+import socketserver
+import subprocess
 import sys
-import gzip
-import os
+import threading
+import urllib.parse
+import numpy as np
+
+from minhash import load_sketch_file, pad_sketches, sketch_sequence_files, query_distances, \
+    build_containment_index, screen_sequence_files, containment_distances
+from sequence_reader import open_sequence_file
+
+
+# Inputs are streamed to Mash in chunks of this many bytes.
+PIPE_CHUNK_SIZE = 1024 * 1024
 
 
 def get_arguments():
@@ -34,8 +84,9 @@ def get_arguments():
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('mash_sketch', type=str,
-                        help='Mash sketch file of Bacsorted assemblies/clusters directory')
-    parser.add_argument('input', type=str,  nargs='+',
+                        help='Mash sketch file (or .npz sketch file from sketch_assemblies.py) '
+                             'of Bacsorted assemblies/clusters directory')
+    parser.add_argument('input', type=str,  nargs='*',
                         help='Assembly FASTA file or read FASTQ files')
 
     parser.add_argument('--input_type', type=str, required=False, default='auto',
@@ -47,63 +98,486 @@ def get_arguments():
                         help='Mash distances at or below this threshold count as a match '
                              '(expressed as a percent)')
     parser.add_argument('--threads', type=int, required=False, default=4,
-                        help='Number of threads to use with Mash')
+                        help='Number of threads to use with Mash (or samples to sketch at once '
+                             'with --manifest)')
     parser.add_argument('-m', type=int, required=False, default=3,
                         help='-m option for Mash (only applies when using reads as input)')
+    parser.add_argument('--top', type=int, required=False, default=0,
+                        help='Report this many closest references (or species, with '
+                             '--species_summary) instead of only the best match')
+    parser.add_argument('--species_summary', action='store_true',
+                        help='Report the best and median distance for each species instead of '
+                             'only the best match')
+    parser.add_argument('--screen', action='store_true',
+                        help='Classify by the containment of each reference in the input '
+                             '(streamed once, stopping early when the result is clear) instead '
+                             'of by sketch distance (requires an .npz reference)')
+    parser.add_argument('--screen_margin', type=float, required=False, default=2.0,
+                        help='With --screen, stop reading once the best species is this much '
+                             'closer than any other (expressed as a percent)')
+    parser.add_argument('--manifest', type=str, required=False,
+                        help='Classify each sample in this tab-delimited file (sample name, '
+                             'then one or more FASTA/FASTQ paths per line) instead of the input '
+                             'files')
+    parser.add_argument('--serve', type=str, required=False,
+                        help='Run as a server with the reference loaded once, listening for '
+                             'HTTP requests on this local port number or Unix socket path '
+                             '(requires an .npz reference)')
     args = parser.parse_args()
 
-    if args.input_type == 'auto':
-        input_types = set(get_sequence_filetype(x) for x in args.input)
-        if len(input_types) != 1:
-            sys.exit('Error: could not determine input type - use --input_type to specify')
-        input_type = list(input_types)[0]
-        if len(args.input) == 1 and input_type == 'FASTA':
-            args.input_type = 'assembly'
-        elif input_type == 'FASTQ':
-            args.input_type = 'reads'
-        else:
-            sys.exit('Error: could not determine input type - use --input_type to specify')
+    if args.screen and not is_native_reference(args.mash_sketch):
+        sys.exit('Error: --screen requires an .npz sketch file made by sketch_assemblies.py')
+    if args.serve is not None and args.manifest is not None:
+        sys.exit('Error: --serve and --manifest cannot be used together')
+    if args.serve is not None or args.manifest is not None:
+        if args.input:
+            sys.exit('Error: input files cannot be given with --serve or --manifest')
+        if args.serve is not None and not is_native_reference(args.mash_sketch):
+            sys.exit('Error: --serve requires an .npz sketch file made by sketch_assemblies.py')
+    elif not args.input:
+        sys.exit('Error: no input files given')
     return args
 
 
 def main():
     args = get_arguments()
+    if args.serve is not None:
+        serve(args)
+        return
+    if args.manifest is not None:
+        classify_manifest(args)
+        return
 
-    cmd = 'cat ' + ' '.join(args.input) + ' | mash dist '
-    cmd += '-s {} '.format(args.sketch_size)
-    if args.input_type == 'reads':
-        cmd += '-m {} '.format(args.m)
-    cmd += '-p {} '.format(args.threads)
-    cmd += '{} -'.format(args.mash_sketch)
+    if is_native_reference(args.mash_sketch):
+        args.input_type = get_input_type(args.input, args.input_type)
+        reference = load_reference(args.mash_sketch, args.screen)
+        names, species, distances = classify_with_reference(reference, args.input,
+                                                            args.input_type, args)
+    else:
+        with open_inputs(args.input) as streams:
+            args.input_type = get_input_type(args.input, args.input_type, streams)
+            names, species, distances = classify_with_mash(args, streams, args.input_type)
+    sample_name = get_sample_name(args.input, args.input_type)
+    for line in get_result_lines(sample_name, names, species, distances, args):
+        print(line)
 
-    with open(os.devnull, 'w') as devnull:
-        mash_out = subprocess.check_output(cmd, shell=True, stderr=devnull).decode()
 
-    best_species, best_distance = 'none', 1.0
-    for line in mash_out.splitlines():
-        parts = line.split('\t')
-        distance = float(parts[2])
+def load_manifest(manifest_filename):
+    """
+    Returns a list of (sample name, input files) from the manifest. Blank lines and lines
+    starting with # are skipped.
+    """
+    samples = []
+    with open(manifest_filename, 'rt') as manifest:
+        for line_num, line in enumerate(manifest, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            parts = [p.strip() for p in line.rstrip('\r\n').split('\t') if p.strip()]
+            if len(parts) < 2:
+                sys.exit('Error: line {} of {} needs a sample name and at least one '
+                         'file'.format(line_num, manifest_filename))
+            samples.append((parts[0], parts[1:]))
+    return samples
+
+
+def classify_manifest(args):
+    """
+    Classifies each sample in the manifest, printing each result as soon as it is ready. With an
+    .npz reference, samples are sketched in a process pool and compared to the reference (loaded
+    once) in this process, or with --screen, screened in a process pool whose workers each get
+    the reference's index once. With a Mash reference, up to --threads Mash processes run at
+    once.
+    Samples which can't be classified (e.g. a missing file) are reported on stderr and skipped.
+    """
+    samples = load_manifest(args.manifest)
+    native = is_native_reference(args.mash_sketch)
+    if native and args.screen:
+        reference = load_reference(args.mash_sketch, screen=True)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.threads,
+                                                          initializer=init_screen_worker,
+                                                          initargs=(reference,))
+    elif native:
+        reference = load_reference(args.mash_sketch)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.threads)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.threads)
+        args.threads = 1  # each Mash process gets one thread
+
+    failed_count = 0
+    with executor:
+        futures = {}
+        for sample_name, inputs in samples:
+            if native and args.screen:
+                future = executor.submit(screen_sample, inputs, args.input_type, args.m,
+                                         args.threshold, args.screen_margin)
+            elif native:
+                future = executor.submit(sketch_sample, inputs, args.input_type,
+                                         reference.kmer_size, reference.sketch_size, args.m)
+            else:
+                future = executor.submit(classify_sample_with_mash, args, inputs)
+            futures[future] = sample_name
+        for future in concurrent.futures.as_completed(futures):
+            sample_name = futures[future]
+            try:
+                result = future.result()
+            except (SystemExit, OSError, subprocess.CalledProcessError) as e:
+                print('{}: {}'.format(sample_name, e), file=sys.stderr, flush=True)
+                failed_count += 1
+                continue
+            if native and args.screen:
+                names, species, distances = reference.names, reference.species, result
+            elif native:
+                names, species, distances = classify_sketch(reference, result)
+            else:
+                names, species, distances = result
+            for line in get_result_lines(sample_name, names, species, distances, args):
+                print(line, flush=True)
+    if failed_count:
+        sys.exit('Error: {} samples could not be classified'.format(failed_count))
 
-        genus = parts[0].split('/')[0]
-        species = parts[0].split('/')[1]
-        binomial = genus + ' ' + species
 
-        if distance <= (args.threshold / 100.0) and distance < best_distance:
-            best_species, best_distance = binomial, distance
+def sketch_sample(inputs, input_type, kmer_size, sketch_size, min_copies):
+    input_type = get_input_type(inputs, input_type)
+    min_copies = min_copies if input_type == 'reads' else 1
+    return sketch_sequence_files(inputs, kmer_size, sketch_size, min_copies)
+
+
+def classify_sample_with_mash(args, inputs):
+    with open_inputs(inputs) as streams:
+        input_type = get_input_type(inputs, args.input_type, streams)
+        return classify_with_mash(args, streams, input_type)
+
+
+@contextlib.contextmanager
+def open_inputs(inputs):
+    """
+    Opens each input file with open_sequence_file and yields the list of open files.
+    """
+    with contextlib.ExitStack() as stack:
+        yield [stack.enter_context(open_sequence_file(x)) for x in inputs]
+
+
+def get_input_type(inputs, input_type, streams=None):
+    """
+    Works out the input type from the inputs' contents, if it wasn't given. If the inputs are
+    already open (streams), their starts are peeked at instead of opening them again.
+    """
+    if input_type != 'auto':
+        return input_type
+    if streams is None:
+        with open_inputs(inputs) as streams:
+            return get_input_type(inputs, input_type, streams)
+    input_types = set(get_sequence_filetype(f, x) for f, x in zip(streams, inputs))
+    if len(input_types) != 1:
+        sys.exit('Error: could not determine input type - use --input_type to specify')
+    input_type = list(input_types)[0]
+    if len(inputs) == 1 and input_type == 'FASTA':
+        return 'assembly'
+    elif input_type == 'FASTQ':
+        return 'reads'
+    else:
+        sys.exit('Error: could not determine input type - use --input_type to specify')
+
+
+def classify_with_mash(args, streams, input_type):
+    """
+    Runs mash dist on the inputs, given as files opened by open_sequence_file (so any format it
+    supports can be used). They are decompressed here and streamed to Mash's stdin from a
+    separate thread, so reading and decompression overlap with Mash's sketching.
+    """
+    cmd = ['mash', 'dist', '-s', str(args.sketch_size)]
+    if input_type == 'reads':
+        cmd += ['-m', str(args.m)]
+    cmd += ['-p', str(args.threads), args.mash_sketch, '-']
+
+    errors = []
+    try:
+        mash = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        sys.exit('Error: could not find mash - is it installed?')
+    with mash:
+        feeder = threading.Thread(target=feed_inputs, args=(streams, mash.stdin, errors))
+        feeder.start()
+        mash_out = mash.stdout.read().decode()
+        feeder.join()
+    if errors:
+        raise errors[0]
+    if mash.returncode != 0:
+        raise subprocess.CalledProcessError(mash.returncode, cmd)
+    return parse_mash_output(mash_out)
+
+
+def feed_inputs(streams, pipe, errors):
+    """
+    Writes the decompressed inputs, one after the other, to the pipe and then closes it. Errors
+    are added to the list, for the calling thread to raise.
+    """
+    try:
+        for f in streams:
+            shutil.copyfileobj(f, pipe, PIPE_CHUNK_SIZE)
+    except BrokenPipeError:
+        pass  # Mash exited early, which its exit code reports
+    except (OSError, SystemExit) as e:
+        errors.append(e)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def parse_mash_output(mash_out):
+    """
+    Returns the reference names, their species and a NumPy array of their distances, with each
+    line split only once.
+    """
+    rows = [line.split('\t', 3) for line in mash_out.splitlines() if line]
+    names = [r[0] for r in rows]
+    distances = np.array([r[2] for r in rows], dtype=np.float64)
+    return names, [get_species_name(n) for n in names], distances
+
+
+def get_species_name(reference_name):
+    """
+    References are named genus/species/assembly (possibly with more directories in front).
+    """
+    parts = reference_name.split('/')
+    if len(parts) < 3:
+        sys.exit('Error: {} is not named genus/species/assembly'.format(reference_name))
+    return parts[-3] + ' ' + parts[-2]
+
+
+def get_result_lines(sample_name, names, species, distances, args):
+    if args.species_summary:
+        return get_species_summary_lines(sample_name, species, distances, args.top)
+    if args.top > 0:
+        return get_top_hit_lines(sample_name, names, species, distances, args.top)
+    best_species, best_distance = 'none', 1.0
+    if len(distances) > 0:
+        best = int(np.argmin(distances))
+        if distances[best] <= args.threshold / 100.0:
+            best_species, best_distance = species[best], float(distances[best])
+    return [get_result_line(sample_name, best_species, best_distance)]
+
 
+def get_result_line(sample_name, best_species, best_distance):
     if best_species == 'none':
         identity = ''
     else:
-        identity = '%.2f' % (100 * (1.0 - best_distance)) + '%'
-    sample_name = get_sample_name(args)
-    print('\t'.join([sample_name, best_species, identity]))
+        identity = get_identity(best_distance)
+    return '\t'.join([sample_name, best_species, identity])
 
 
-def get_sample_name(args):
-    input = args.input[0]
+def get_identity(distance):
+    return '%.2f' % (100 * (1.0 - distance)) + '%'
+
+
+def get_top_hit_lines(sample_name, names, species, distances, top):
+    """
+    Returns lines for the closest references, found with a partial sort (ties are broken by
+    reference order).
+    """
+    count = min(top, len(distances))
+    if count == 0:
+        return []
+    closest = np.argpartition(distances, count - 1)[:count]
+    closest = closest[np.lexsort((closest, distances[closest]))]
+    return ['\t'.join([sample_name, str(rank), species[i], get_identity(distances[i]), names[i]])
+            for rank, i in enumerate(closest.tolist(), 1)]
+
+
+def get_species_summary_lines(sample_name, species, distances, top):
+    """
+    Returns a line for each species (or the closest top species) with its best and median
+    distance. The references are sorted once by species then distance, so each species' best is
+    its first distance and its median comes from the middle of its run.
+    """
+    if len(distances) == 0:
+        return []
+    species_names, species_indices = np.unique(np.array(species), return_inverse=True)
+    order = np.lexsort((distances, species_indices))
+    sorted_distances = distances[order]
+    counts = np.bincount(species_indices, minlength=len(species_names))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    best = sorted_distances[starts]
+    median = (sorted_distances[starts + (counts - 1) // 2] +
+              sorted_distances[starts + counts // 2]) / 2.0
+    species_order = np.lexsort((species_names, best))
+    if top > 0:
+        species_order = species_order[:top]
+    return ['\t'.join([sample_name, species_names[i], get_identity(best[i]),
+                       get_identity(median[i]), str(counts[i])])
+            for i in species_order.tolist()]
+
+
+def is_native_reference(sketch_filename):
+    return sketch_filename.endswith('.npz')
+
+
+Reference = collections.namedtuple('Reference', ['names', 'species', 'sketches', 'index',
+                                                 'kmer_size', 'sketch_size'])
+
+
+def load_reference(sketch_filename, screen=False):
+    """
+    Loads an .npz sketch file into memory, with each sketch's species taken from its path
+    (genus/species/assembly) and the sketches padded into one 2D array for fast comparison. For
+    screening, a containment index of the sketches is built instead.
+    """
+    sketches, kmer_size, sketch_size = load_sketch_file(sketch_filename)
+    if not sketches:
+        sys.exit('Error: could not load sketches from {}'.format(sketch_filename))
+    names = sorted(sketches)
+    species = [get_species_name(n) for n in names]
+    sketch_list = [sketches[n][2] for n in names]
+    if screen:
+        return Reference(names, species, None, build_containment_index(sketch_list), kmer_size,
+                         sketch_size)
+    padded = pad_sketches(sketch_list, sketch_size)
+    return Reference(names, species, padded, None, kmer_size, sketch_size)
+
+
+def classify_with_reference(reference, inputs, input_type, args):
+    if args.screen:
+        return screen_natively(reference, inputs, input_type, args.m, args.threshold,
+                               args.screen_margin)
+    return classify_natively(reference, inputs, input_type, args.m)
+
+
+def classify_natively(reference, inputs, input_type, min_copies):
+    """
+    Sketches the input files (with the reference's k-mer and sketch sizes) and returns the
+    reference names, their species and their distances to the query.
+    """
+    query = sketch_sample(inputs, input_type, reference.kmer_size, reference.sketch_size,
+                          min_copies)
+    return classify_sketch(reference, query)
+
+
+def classify_sketch(reference, query):
+    query = pad_sketches([query], reference.sketch_size)[0]
+    distances = query_distances(query, reference.sketches, reference.kmer_size,
+                                reference.sketch_size)
+    return reference.names, reference.species, distances
+
+
+def screen_natively(reference, inputs, input_type, min_copies, threshold, margin):
+    """
+    Streams the input files against the reference's containment index and returns the reference
+    names, their species and their containment-based distances to the query. Reading stops once
+    the best species is within the threshold and at least the margin (both percents) closer
+    than the runner-up species.
+    """
+    input_type = get_input_type(inputs, input_type)
+    min_copies = min_copies if input_type == 'reads' else 1
+    species_names, species_indices = np.unique(np.array(reference.species), return_inverse=True)
+
+    def is_decided(containments):
+        species_best = np.ones(len(species_names))
+        np.minimum.at(species_best, species_indices,
+                      containment_distances(containments, reference.kmer_size))
+        best = species_best.min()
+        runner_up = np.partition(species_best, 1)[1] if len(species_best) > 1 else 1.0
+        return best <= threshold / 100.0 and runner_up - best >= margin / 100.0
+
+    containments = screen_sequence_files(inputs, reference.index, reference.kmer_size,
+                                         min_copies, is_decided)
+    distances = containment_distances(containments, reference.kmer_size)
+    return reference.names, reference.species, distances
+
+
+# Process pool workers get the screening reference once, when they start, rather than with
+# every sample.
+worker_reference = None
+
+
+def init_screen_worker(reference):
+    global worker_reference
+    worker_reference = reference
+
+
+def screen_sample(inputs, input_type, min_copies, threshold, margin):
+    return screen_natively(worker_reference, inputs, input_type, min_copies, threshold,
+                           margin)[2]
+
+
+def serve(args):
+    print('Loading {}...'.format(args.mash_sketch), end='', file=sys.stderr, flush=True)
+    reference = load_reference(args.mash_sketch, args.screen)
+    print(' done ({} sketches)'.format(len(reference.species)), file=sys.stderr, flush=True)
+
+    if args.serve.isdigit():
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', int(args.serve)),
+                                                 ClassifyRequestHandler)
+    else:
+        if pathlib.Path(args.serve).is_socket():
+            os.remove(args.serve)
+        server = ThreadingUnixHTTPServer(args.serve, ClassifyRequestHandler)
+    server.reference, server.args = reference, args
+    print('Listening on {}'.format(args.serve), file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not args.serve.isdigit() and pathlib.Path(args.serve).is_socket():
+            os.remove(args.serve)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ClassifyRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers GET /classify?input=...[&input=...][&input_type=...] with result lines. Each request
+    is handled in its own thread, sharing the server's reference.
+    """
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/classify':
+            self.send_text(404, 'Error: unknown path {}\n'.format(url.path))
+            return
+        query = urllib.parse.parse_qs(url.query)
+        inputs = query.get('input', [])
+        args = self.server.args
+        try:
+            if not inputs:
+                sys.exit('Error: no input files given')
+            missing = [f for f in inputs if not pathlib.Path(f).is_file()]
+            if missing:
+                sys.exit('Error: {} does not exist'.format(missing[0]))
+            input_type = get_input_type(inputs, query.get('input_type', [args.input_type])[0])
+            names, species, distances = classify_with_reference(self.server.reference, inputs,
+                                                                input_type, args)
+        except SystemExit as e:
+            self.send_text(400, '{}\n'.format(e))
+            return
+        sample_name = get_sample_name(inputs, input_type)
+        lines = get_result_lines(sample_name, names, species, distances, args)
+        self.send_text(200, ''.join(line + '\n' for line in lines))
+
+    def send_text(self, status, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else 'local'
+
+
+def get_sample_name(inputs, input_type):
+    input = inputs[0]
     sample_name = pathlib.Path(input).name
-    if sample_name.endswith('.gz'):
-        sample_name = sample_name[:-3]
+    for extension in ('.gz', '.bz2', '.xz', '.zst'):
+        if sample_name.endswith(extension):
+            sample_name = sample_name[:-len(extension)]
     if sample_name.endswith('.fna'):
         sample_name = sample_name[:-4]
     if sample_name.endswith('.fasta'):
@@ -112,47 +586,24 @@ def get_sample_name(args):
         sample_name = sample_name[:-6]
     if sample_name.endswith('.fq'):
         sample_name = sample_name[:-3]
-    if args.input_type == 'reads' and sample_name.endswith('_1'):
+    if input_type == 'reads' and sample_name.endswith('_1'):
         sample_name = sample_name[:-2]
-    if args.input_type == 'reads' and sample_name.endswith('_R1'):
+    if input_type == 'reads' and sample_name.endswith('_R1'):
         sample_name = sample_name[:-3]
     return sample_name
 
 
-def get_compression_type(filename):
-    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
-                  'bz2': (b'\x42', b'\x5a', b'\x68'),
-                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
-    max_len = max(len(x) for x in magic_dict)
-    with open(filename, 'rb') as unknown_file:
-        file_start = unknown_file.read(max_len)
-    compression_type = 'plain'
-    for file_type, magic_bytes in magic_dict.items():
-        if file_start.startswith(magic_bytes):
-            compression_type = file_type
-    if compression_type == 'bz2':
-        sys.exit('Error: cannot use bzip2 format - use gzip instead')
-    if compression_type == 'zip':
-        sys.exit('Error: cannot use zip format - use gzip instead')
-    return compression_type
-
-
-def get_open_function(filename):
-    if get_compression_type(filename) == 'gz':
-        return gzip.open
-    else:  # plain text
-        return open
-
-
-def get_sequence_filetype(filename):
-    with get_open_function(filename)(filename, 'rt') as fh:
-        for line in fh:
-            if line.startswith('>'):
-                return 'FASTA'
-            elif line.startswith('@'):
-                return 'FASTQ'
-            else:
-                sys.exit('Could not determine type of {} (must be FASTA or FASTQ'.format(filename))
+def get_sequence_filetype(f, filename):
+    """
+    Returns FASTA or FASTQ from the first byte of the (decompressed) file opened by
+    open_sequence_file. The byte is only peeked at, so the file can still be read from the start.
+    """
+    first_byte = f.peek(1)[:1]
+    if first_byte == b'>':
+        return 'FASTA'
+    elif first_byte == b'@':
+        return 'FASTQ'
+    sys.exit('Error: could not determine type of {} (must be FASTA or FASTQ)'.format(filename))
 
 
 if __name__ == '__main__':
@@ -19,11 +19,40 @@ not, see <http://www.gnu.org/licenses/>.
 
 import argparse
 import collections
-import gzip
+import concurrent.futures
+import contextlib
+import hashlib
+import io
 import os
 import pathlib
 import re
 import shutil
+import sys
+import numpy as np
+
+from minhash import update_sketch_file, close_pairs, DEFAULT_KMER_SIZE
+from sequence_reader import get_sequence_lengths
+
+
+# Mash distances are read in chunks of roughly this many bytes.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Each genus directory gets a cache of assembly stats (used to choose cluster representatives),
+# so re-clustering doesn't need to read the assemblies again.
+ASSEMBLY_STATS_FILENAME = 'assembly_stats.tsv'
+
+# Each genus directory also records the threshold used and how much of mash_distances has been
+# clustered, so --incremental can extend the clusters using only newly appended distances.
+CLUSTERING_STATE_FILENAME = 'clustering_state.tsv'
+
+# The state also has a checksum of this many bytes from each end of the clustered part of
+# mash_distances, so a rewritten file (rather than an appended one) is noticed.
+CHECKSUM_WINDOW_SIZE = 1024 * 1024
+
+# With --sketch, each genus directory gets a file of MinHash sketches instead of needing a
+# mash_distances file. The sketch size matches download_genomes.sh's Mash sketches.
+SKETCH_FILENAME = 'sketches.npz'
+SKETCH_SIZE = 10000
 
 
 def get_arguments():
@@ -36,6 +65,16 @@ def get_arguments():
                         help='Mash distance clustering threshold')
     parser.add_argument('--excluded', type=str, required=False, default='excluded_assemblies',
                         help='File containing assembly accessions to exclude (one per line)')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of genera to cluster in parallel')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Extend the clusters in the existing cluster_accessions file using '
+                             'distances added since the last run, keeping the names and '
+                             'representatives of unchanged clusters')
+    parser.add_argument('--sketch', action='store_true',
+                        help='Sketch the assemblies and compute their distances in-process, '
+                             'instead of reading the mash_distances file made by '
+                             'download_genomes.sh')
     args = parser.parse_args()
     return args
 
@@ -48,122 +87,522 @@ def main():
     genera = sorted(os.path.basename(str(x)) for x in pathlib.Path(args.assembly_dir).iterdir()
                     if x.is_dir())
 
-    for genus in genera:
+    # In incremental mode, the existing clusters are loaded so they can be extended (instead of
+    # rebuilt) and so unchanged clusters keep their names and representatives.
+    if args.incremental:
+        previous_clusters = load_previous_clusters()
+    else:
+        previous_clusters = {}
+    # With only one genus, the threads are used for sketching instead.
+    sketch_threads = args.threads if len(genera) == 1 else 1
+    jobs = [(args.assembly_dir, genus, args.threshold, excluded, args.incremental,
+             previous_clusters.get(genus, []), args.sketch, sketch_threads) for genus in genera]
+
+    # Each genus is clustered independently (possibly in parallel), but the results are always
+    # written in sorted genus order so the output doesn't depend on the number of threads.
+    all_clusters = dict(previous_clusters)
+    if args.threads > 1 and len(genera) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
+            for genus, output, clusters in executor.map(cluster_genus, jobs):
+                save_genus_clusters(genus, output, clusters, previous_clusters.get(genus, []),
+                                    not args.incremental)
+                if clusters is not None:
+                    all_clusters[genus] = clusters
+    else:
+        for genus, output, clusters in map(cluster_genus, jobs):
+            save_genus_clusters(genus, output, clusters, previous_clusters.get(genus, []),
+                                not args.incremental)
+            if clusters is not None:
+                all_clusters[genus] = clusters
+
+    if args.incremental:
+        with open('cluster_accessions', 'wt') as cluster_accessions_file:
+            for genus in sorted(all_clusters):
+                for cluster_name, assemblies, representative in all_clusters[genus]:
+                    cluster_accessions_file.write(get_cluster_line(cluster_name, assemblies,
+                                                                   representative))
+                    cluster_accessions_file.write('\n')
+
+
+def cluster_genus(job):
+    """
+    Clusters one genus and chooses a representative for each cluster. Returns the genus, the
+    text which would have been printed (so parallel genera don't interleave their output) and a
+    list of (cluster name, assemblies, representative), or None if the genus was skipped.
+    """
+    assembly_dir, genus, threshold, excluded, incremental, previous_clusters, sketch, \
+        sketch_threads = job
+    genus_dir = assembly_dir + '/' + genus
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
         print()
         print('Clustering ' + genus)
         print('------------------------------------------------')
 
-        distance_filename = args.assembly_dir + '/' + genus + '/mash_distances'
-        if not pathlib.Path(distance_filename).is_file():
-            print('Could not find pairwise distances file - skipping genus')
+        if sketch:
+            distance_filename = None
+        else:
+            distance_filename = genus_dir + '/mash_distances'
+            if not pathlib.Path(distance_filename).is_file():
+                print('Could not find pairwise distances file - skipping genus')
+                print()
+                return genus, output.getvalue(), None
+
+        start_offset, known_clusters = 0, []
+        if incremental and previous_clusters:
+            start_offset = get_incremental_start(genus_dir, distance_filename, threshold,
+                                                 excluded, previous_clusters)
+            if start_offset is None:
+                print('Existing clusters cannot be extended - clustering from scratch')
+                start_offset = 0
+            else:
+                known_clusters = [assemblies for _, assemblies, _ in previous_clusters]
+
+        if sketch:
+            assemblies, union_find = load_sketch_distances(genus_dir, threshold, excluded,
+                                                           known_clusters, sketch_threads)
+            end_offset = None
+        else:
+            assemblies, union_find, end_offset = load_distances(distance_filename, threshold,
+                                                                excluded, start_offset,
+                                                                known_clusters)
+        if sketch and not assemblies:
+            print('No assemblies found - skipping genus')
             print()
-            continue
-
-        assemblies, graph = create_graph_from_distances(distance_filename, args.threshold, excluded)
-        clusters = cluster_assemblies(assemblies, graph)
-
-        if not pathlib.Path('clusters').is_dir():
-            os.makedirs('clusters')
-
-        print()
+            return genus, output.getvalue(), None
+        clusters = cluster_assemblies(assemblies, union_find)
+        save_clustering_state(genus_dir, threshold, excluded, distance_filename, end_offset)
+
+    assembly_stats = load_assembly_stats('assemblies/' + genus)
+    named_clusters = name_clusters(genus, clusters, previous_clusters, assembly_stats)
+    save_assembly_stats('assemblies/' + genus, assembly_stats)
+    return genus, output.getvalue(), named_clusters
+
+
+def name_clusters(genus, clusters, previous_clusters, assembly_stats):
+    """
+    Gives each cluster a name and a representative. A cluster identical to a previous cluster
+    keeps its name and representative. A cluster which has grown takes the name of the first
+    previous cluster it contains, and other clusters get new numbers after the previous ones.
+    """
+    previous_by_assembly = {}
+    for cluster_name, assemblies, representative in previous_clusters:
+        for assembly in assemblies:
+            previous_by_assembly[assembly] = (cluster_name, assemblies, representative)
+
+    if previous_clusters:
+        next_num = max(int(name.rsplit('_', 1)[1]) for name, _, _ in previous_clusters) + 1
+        cluster_num_digits = len(previous_clusters[0][0].rsplit('_', 1)[1])
+    else:
+        next_num = 1
         cluster_num_digits = len(str(len(clusters)))
-        cluster_num_format = '%0' + str(cluster_num_digits) + 'd'
-        with open('cluster_accessions', 'at') as cluster_accessions_file:
-            for num, assemblies in clusters.items():
-                cluster_name = genus + '_' + (cluster_num_format % num)
-
-                # Choose representative for each cluster by N50.
-                if len(assemblies) == 1:
-                    representative = assemblies[0]
-                else:
-                    representative = sorted([(get_assembly_n50('assemblies/' + genus + '/' + a), a)
-                                             for a in assemblies])[-1][1]
-
-                out_line = cluster_name + '\t' + \
-                    ','.join([(a + '*' if a == representative else a) for a in assemblies])
+    cluster_num_format = '%0' + str(cluster_num_digits) + 'd'
+
+    named_clusters = []
+    used_names = set()
+    for num, assemblies in clusters.items():
+        previous = sorted(set(previous_by_assembly[a] for a in assemblies
+                              if a in previous_by_assembly))
+        previous = [p for p in previous if p[0] not in used_names]
+        if not previous_clusters:
+            cluster_name = genus + '_' + (cluster_num_format % num)
+        elif previous:
+            cluster_name = previous[0][0]
+        else:
+            cluster_name = genus + '_' + (cluster_num_format % next_num)
+            next_num += 1
+        used_names.add(cluster_name)
+
+        if previous and previous[0][1] == assemblies:
+            representative = previous[0][2]
+
+        # Choose representative for each cluster by N50.
+        elif len(assemblies) == 1:
+            representative = assemblies[0]
+        else:
+            representative = sorted([(get_assembly_stats('assemblies/' + genus, a,
+                                                         assembly_stats).n50, a)
+                                     for a in assemblies])[-1][1]
+        named_clusters.append((cluster_name, assemblies, representative))
+
+    return sorted(named_clusters, key=lambda c: (int(c[0].rsplit('_', 1)[1]), c[0]))
+
+
+def save_genus_clusters(genus, output, clusters, previous_clusters, append):
+    print(output, end='', flush=True)
+    if clusters is None:
+        return
+
+    if not pathlib.Path('clusters').is_dir():
+        os.makedirs('clusters')
+
+    # Previous clusters which were merged into another cluster no longer exist.
+    cluster_names = set(c[0] for c in clusters)
+    for cluster_name, _, _ in previous_clusters:
+        if cluster_name not in cluster_names:
+            cluster_file = pathlib.Path('clusters/' + cluster_name + '.fna.gz')
+            if cluster_file.is_file():
+                cluster_file.unlink()
+
+    unchanged = set(previous_clusters)
+    print()
+    for cluster_name, assemblies, representative in clusters:
+        out_line = get_cluster_line(cluster_name, assemblies, representative)
+        if append:
+            with open('cluster_accessions', 'at') as cluster_accessions_file:
                 cluster_accessions_file.write(out_line)
                 cluster_accessions_file.write('\n')
-                print(out_line)
-
-                shutil.copyfile('assemblies/' + genus + '/' + representative,
-                                'clusters/' + cluster_name + '.fna.gz')
-        print()
-
-
-def create_graph_from_distances(distance_filename, threshold, excluded):
-    print('Loading distances...', end='', flush=True)
+        print(out_line)
 
-    assemblies = set()
-    graph = collections.defaultdict(set)
-    all_connections = collections.defaultdict(set)
-
-    with open(distance_filename, 'rt') as distance_file:
-        for line in distance_file:
-            parts = line.split('\t')
+        cluster_filename = 'clusters/' + cluster_name + '.fna.gz'
+        if (cluster_name, assemblies, representative) in unchanged and \
+                pathlib.Path(cluster_filename).is_file():
+            continue
+        shutil.copyfile('assemblies/' + genus + '/' + representative, cluster_filename)
+    print()
 
-            assembly_1 = parts[0]
-            assembly_2 = parts[1]
-            distance = float(parts[2])
 
-            # Skip this line if either assembly has been excluded. We check the first 13 characters
-            # of the assembly name because that's the accession up to the version number. E.g. the
-            # full assembly name might be GCF_002053395.1.fna.gz but we just check the first 13
-            # characters (GCF_002053395).
-            if assembly_1[:13] in excluded or assembly_2[:13] in excluded:
-                continue
+def get_cluster_line(cluster_name, assemblies, representative):
+    return cluster_name + '\t' + \
+        ','.join([(a + '*' if a == representative else a) for a in assemblies])
 
-            assemblies.add(assembly_1)
-            assemblies.add(assembly_2)
 
-            if assembly_1 == assembly_2:
+def load_previous_clusters():
+    """
+    Loads the existing cluster_accessions file, returning a dictionary of genus to a list of
+    (cluster name, assemblies, representative).
+    """
+    previous_clusters = collections.defaultdict(list)
+    if not pathlib.Path('cluster_accessions').is_file():
+        return previous_clusters
+    with open('cluster_accessions', 'rt') as cluster_accessions_file:
+        for line in cluster_accessions_file:
+            parts = line.strip().split('\t')
+            if len(parts) < 2:
                 continue
+            cluster_name = parts[0]
+            genus = cluster_name.rsplit('_', 1)[0]
+            assemblies = tuple(a.rstrip('*') for a in parts[1].split(','))
+            representative = [a.rstrip('*') for a in parts[1].split(',') if a.endswith('*')][0]
+            previous_clusters[genus].append((cluster_name, assemblies, representative))
+    return previous_clusters
+
+
+def get_incremental_start(genus_dir, distance_filename, threshold, excluded, previous_clusters):
+    """
+    Returns the position in the distances file up to which the previous clusters were made, so
+    only the lines after it (distances for new assemblies) need to be read. Returns None if the
+    previous clusters can't simply be extended: different threshold, a rewritten distances file,
+    newly excluded assemblies in the clusters or assemblies which are no longer excluded (their
+    distances are in the already-clustered part of the file). A rewritten distances file is
+    recognised by the checksum of the clustered part no longer matching. With no distances file
+    (the clusters come from sketches), the previous clusters must also have come from sketches.
+    """
+    state_filename = genus_dir + '/' + CLUSTERING_STATE_FILENAME
+    if not pathlib.Path(state_filename).is_file():
+        return None
+    with open(state_filename, 'rt') as state_file:
+        state = dict(line.rstrip('\n').split('\t') for line in state_file if '\t' in line)
+    try:
+        previous_threshold = float(state['threshold'])
+        clustered_bytes = None if state['clustered_bytes'] == 'sketches' \
+            else int(state['clustered_bytes'])
+        previous_excluded = set(state['excluded'].split(',')) - {''}
+    except (KeyError, ValueError):
+        return None
+    if previous_threshold != threshold or not previous_excluded <= excluded:
+        return None
+    if distance_filename is None:
+        if clustered_bytes is not None:
+            return None
+        clustered_bytes = 0
+    elif clustered_bytes is None or clustered_bytes > os.path.getsize(distance_filename) or \
+            state.get('clustered_checksum') != get_clustered_checksum(distance_filename,
+                                                                      clustered_bytes):
+        return None
+    for _, assemblies, _ in previous_clusters:
+        if any(a[:13] in excluded for a in assemblies):
+            return None
+    return clustered_bytes
+
+
+def save_clustering_state(genus_dir, threshold, excluded, distance_filename, clustered_bytes):
+    with open(genus_dir + '/' + CLUSTERING_STATE_FILENAME, 'wt') as state_file:
+        state_file.write('threshold\t{}\n'.format(threshold))
+        state_file.write('excluded\t{}\n'.format(','.join(sorted(excluded))))
+        if distance_filename is None:
+            state_file.write('clustered_bytes\tsketches\n')
+        else:
+            state_file.write('clustered_bytes\t{}\n'.format(clustered_bytes))
+            state_file.write('clustered_checksum\t{}\n'.format(
+                get_clustered_checksum(distance_filename, clustered_bytes)))
+
+
+def get_clustered_checksum(distance_filename, clustered_bytes):
+    """
+    Hashes the clustered length and the first and last CHECKSUM_WINDOW_SIZE bytes of the file's
+    first clustered_bytes bytes. Appending distances doesn't change it, but rewriting the file
+    almost certainly does (its first and last lines change). Hashing the whole clustered part
+    would mean reading the entire file, which incremental clustering is meant to avoid.
+    """
+    checksum = hashlib.sha256(str(clustered_bytes).encode())
+    with open(distance_filename, 'rb') as distance_file:
+        checksum.update(distance_file.read(min(clustered_bytes, CHECKSUM_WINDOW_SIZE)))
+        tail_start = max(clustered_bytes - CHECKSUM_WINDOW_SIZE, 0)
+        distance_file.seek(tail_start)
+        checksum.update(distance_file.read(clustered_bytes - tail_start))
+    return checksum.hexdigest()
+
+
+def load_distances(distance_filename, threshold, excluded, start_offset=0, known_clusters=()):
+    """
+    Streams through the Mash distances in large chunks. Assemblies are given integer indices when
+    first seen, and pairs closer than the threshold are merged in a union-find structure.
+
+    When extending existing clusters, reading starts at start_offset (the end of the previously
+    clustered distances) and the union-find structure starts with the known clusters.
+    Also returns the position of the end of the file, for the next incremental run.
+    """
+    print('Loading distances...', end='', flush=True)
 
-            all_connections[assembly_1].add(assembly_2)
-            all_connections[assembly_2].add(assembly_1)
-
-            if distance < threshold:
-                graph[assembly_1].add(assembly_2)
-                graph[assembly_2].add(assembly_1)
+    assembly_indices = {}
+    assemblies = []
+    union_find = UnionFind()
+    for cluster in known_clusters:
+        for assembly in cluster:
+            assembly_indices[assembly.encode()] = union_find.add()
+            assemblies.append(assembly)
+            union_find.union(assembly_indices[cluster[0].encode()], len(assemblies) - 1)
+    known_count = len(assemblies)
+    reference_counts = np.zeros(0, dtype=np.int64)
+    query_counts = np.zeros(0, dtype=np.int64)
+
+    with open(distance_filename, 'rb') as distance_file:
+        distance_file.seek(start_offset)
+        while True:
+            chunk = distance_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk += distance_file.readline()  # finish the chunk's last line
+            parsed = parse_distance_chunk(chunk, assembly_indices, assemblies, union_find,
+                                          excluded)
+            if parsed is None:
+                sys.exit('Error: could not parse {}'.format(distance_filename))
+            indices_1, indices_2, distances = parsed
+
+            # Skip pairs where either assembly has been excluded, as well as self-comparisons.
+            included = (indices_1 >= 0) & (indices_2 >= 0) & (indices_1 != indices_2)
+            indices_1, indices_2 = indices_1[included], indices_2[included]
+            distances = distances[included]
+
+            reference_counts = add_counts(reference_counts, indices_1, len(assemblies))
+            query_counts = add_counts(query_counts, indices_2, len(assemblies))
+
+            close = distances < threshold
+            for i, j in zip(indices_1[close].tolist(), indices_2[close].tolist()):
+                union_find.union(i, j)
+        end_offset = distance_file.tell()
 
-    assemblies = sorted(assemblies)
     assembly_count = len(assemblies)
-
     noun = ('assembly' if assembly_count == 1 else 'assemblies')
     print(' found', assembly_count, noun)
 
-    # Sanity check: make sure we have all the connections.
-    for assembly in assemblies:
-        assert len(all_connections[assembly]) == assembly_count - 1
-
-    return assemblies, graph
-
-
-def cluster_assemblies(assemblies, graph):
-    visited = set()
-    i = 0
+    # Sanity check: make sure we have all the connections. Each assembly should be compared to
+    # every other assembly, except that known assemblies were already compared to each other
+    # before start_offset.
+    expected_counts = np.full(assembly_count, assembly_count - 1, dtype=np.int64)
+    expected_counts[:known_count] = assembly_count - known_count
+    reference_counts = add_counts(reference_counts, np.zeros(0, dtype=np.int64), assembly_count)
+    query_counts = add_counts(query_counts, np.zeros(0, dtype=np.int64), assembly_count)
+    assert np.array_equal(reference_counts, expected_counts)
+    assert np.array_equal(query_counts, expected_counts)
+
+    return assemblies, union_find, end_offset
+
+
+def load_sketch_distances(genus_dir, threshold, excluded, known_clusters=(), threads=1):
+    """
+    Sketches the genus's assemblies (reusing the sketch file for unchanged assemblies) and merges
+    pairs closer than the threshold in a union-find structure, with no distances file in between.
+
+    When extending existing clusters, the union-find structure starts with the known clusters and
+    only pairs involving new assemblies are compared.
+    """
+    assemblies = []
+    union_find = UnionFind()
+    for cluster in known_clusters:
+        first = len(assemblies)
+        for assembly in cluster:
+            assemblies.append(assembly)
+            union_find.union(first, union_find.add())
+    known_count = len(assemblies)
+    known = set(assemblies)
+    for assembly_file in sorted(pathlib.Path(genus_dir).glob('*.fna.gz')):
+        assembly = assembly_file.name
+        if assembly not in known and assembly[:13] not in excluded:
+            assemblies.append(assembly)
+            union_find.add()
+
+    sketches = update_sketch_file(genus_dir + '/' + SKETCH_FILENAME,
+                                  [genus_dir + '/' + a for a in assemblies],
+                                  sketch_size=SKETCH_SIZE, threads=threads)
+    print('Finding distances...', end='', flush=True)
+    if known_count < len(assemblies):
+        for i, j in close_pairs(sketches, threshold, DEFAULT_KMER_SIZE, SKETCH_SIZE, threads,
+                                start=known_count):
+            union_find.union(i, j)
+    assembly_count = len(assemblies)
+    noun = ('assembly' if assembly_count == 1 else 'assemblies')
+    print(' found', assembly_count, noun)
+    return assemblies, union_find
+
+
+def parse_distance_chunk(chunk, assembly_indices, assemblies, union_find, excluded):
+    """
+    Parses a chunk of whole Mash output lines into arrays of the two assemblies' indices and the
+    distance for each line. The chunk is split in one step (assembly names can't contain
+    whitespace, so every line has the same number of fields) and each column is converted to an
+    array straight from the split fields, with no per-line Python code. Only assemblies not seen
+    before need any work in Python.
+    """
+    column_count = chunk[:chunk.find(b'\n')].count(b'\t') + 1
+    fields = chunk.split()
+    if column_count < 3 or len(fields) % column_count != 0:
+        return None
+    names_1, names_2 = fields[0::column_count], fields[1::column_count]
+    new_names = (set(names_1) | set(names_2)) - assembly_indices.keys()
+    if new_names:
+        add_assemblies(names_1, names_2, new_names, assembly_indices, assemblies, union_find,
+                       excluded)
+    line_count = len(names_1)
+    indices_1 = np.fromiter(map(assembly_indices.__getitem__, names_1), np.int64, line_count)
+    indices_2 = np.fromiter(map(assembly_indices.__getitem__, names_2), np.int64, line_count)
+    distances = np.fromiter(map(float, fields[2::column_count]), np.float64, line_count)
+    return indices_1, indices_2, distances
+
+
+def add_assemblies(names_1, names_2, new_names, assembly_indices, assemblies, union_find,
+                   excluded):
+    """
+    Gives the new assemblies indices in order of first appearance, scanning only as far as the
+    last of them.
+
+    Excluded assemblies get an index of -1. We check the first 13 characters of the assembly
+    name because that's the accession up to the version number. E.g. the full assembly name might
+    be GCF_002053395.1.fna.gz but we just check the first 13 characters (GCF_002053395).
+    """
+    for pair in zip(names_1, names_2):
+        for assembly in pair:
+            if assembly in new_names and assembly not in assembly_indices:
+                assembly_name = assembly.decode()
+                if assembly_name[:13] in excluded:
+                    assembly_indices[assembly] = -1
+                else:
+                    assembly_indices[assembly] = union_find.add()
+                    assemblies.append(assembly_name)
+                new_names.discard(assembly)
+        if not new_names:
+            break
+
+
+def add_counts(counts, indices, assembly_count):
+    new_counts = np.bincount(indices, minlength=assembly_count)
+    new_counts[:len(counts)] += counts
+    return new_counts
+
+
+class UnionFind(object):
+    """
+    Disjoint-set structure over integer indices, with path compression. When two sets are joined,
+    the smaller root index becomes the root.
+    """
+    def __init__(self):
+        self.parents = []
+
+    def add(self):
+        self.parents.append(len(self.parents))
+        return len(self.parents) - 1
+
+    def find(self, i):
+        parents = self.parents
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+        while parents[i] != root:
+            parents[i], i = root, parents[i]
+        return root
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i < root_j:
+            self.parents[root_j] = root_i
+        elif root_j < root_i:
+            self.parents[root_i] = root_j
+
+
+def cluster_assemblies(assemblies, union_find):
+    """
+    Returns a dictionary of cluster number to a tuple of sorted assembly names. Clusters are
+    numbered in the order of their first assembly (sorted by name).
+    """
+    roots = [union_find.find(i) for i in range(len(assemblies))]
+    members = collections.defaultdict(list)
+    for i in sorted(range(len(assemblies)), key=lambda x: assemblies[x]):
+        members[roots[i]].append(assemblies[i])
     clusters = {}
-    for assembly in assemblies:
-        if assembly in visited:
-            continue
-        i += 1
-        connected = dfs(graph, assembly)
-        clusters[i] = sorted(connected)
-        visited |= connected
+    for num, cluster in enumerate(members.values()):
+        clusters[num + 1] = tuple(cluster)
     return clusters
 
 
-def dfs(graph, start):
-    visited, stack = set(), [start]
-    while stack:
-        vertex = stack.pop()
-        if vertex not in visited:
-            visited.add(vertex)
-            stack.extend(graph[vertex] - visited)
-    return visited
-
-
-def get_assembly_n50(filename):
-    contig_lengths = sorted(get_contig_lengths(filename), reverse=True)
+AssemblyStats = collections.namedtuple('AssemblyStats',
+                                       ['size', 'mtime', 'contig_count', 'total_length', 'n50'])
+
+
+def load_assembly_stats(genus_dir):
+    """
+    Loads the genus's assembly stats cache: a dictionary of assembly filename to AssemblyStats.
+    The file size and modification time are stored so changed assemblies can be recognised.
+    """
+    assembly_stats = {}
+    stats_filename = genus_dir + '/' + ASSEMBLY_STATS_FILENAME
+    if pathlib.Path(stats_filename).is_file():
+        with open(stats_filename, 'rt') as stats_file:
+            for line in stats_file:
+                parts = line.rstrip('\n').split('\t')
+                if parts[0] == 'assembly' or len(parts) != 6:
+                    continue
+                assembly_stats[parts[0]] = AssemblyStats(*(int(x) for x in parts[1:]))
+    return assembly_stats
+
+
+def save_assembly_stats(genus_dir, assembly_stats):
+    stats_filename = genus_dir + '/' + ASSEMBLY_STATS_FILENAME
+    temp_filename = stats_filename + '.tmp'
+    with open(temp_filename, 'wt') as stats_file:
+        stats_file.write('\t'.join(('assembly',) + AssemblyStats._fields) + '\n')
+        for assembly, stats in sorted(assembly_stats.items()):
+            stats_file.write('\t'.join([assembly] + [str(x) for x in stats]) + '\n')
+    os.replace(temp_filename, stats_filename)
+
+
+def get_assembly_stats(genus_dir, assembly, assembly_stats):
+    """
+    Returns the AssemblyStats for one assembly, from the cache if the file is unchanged, otherwise
+    by scanning the file (and adding the result to the cache).
+    """
+    file_stat = os.stat(genus_dir + '/' + assembly)
+    stats = assembly_stats.get(assembly)
+    if stats is None or stats.size != file_stat.st_size or stats.mtime != file_stat.st_mtime_ns:
+        contig_lengths = get_sequence_lengths(genus_dir + '/' + assembly)
+        stats = AssemblyStats(file_stat.st_size, file_stat.st_mtime_ns, len(contig_lengths),
+                              sum(contig_lengths), get_n50(contig_lengths))
+        assembly_stats[assembly] = stats
+    return stats
+
+
+def get_n50(contig_lengths):
+    contig_lengths = sorted(contig_lengths, reverse=True)
     total_length = sum(contig_lengths)
     target_length = total_length * 0.5
     length_so_far = 0
@@ -174,27 +613,6 @@ def get_assembly_n50(filename):
     return 0
 
 
-def get_contig_lengths(filename):
-    lengths = []
-    with gzip.open(filename, 'rt') as fasta_file:
-        name = ''
-        sequence = ''
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    lengths.append(len(sequence))
-                    sequence = ''
-                name = line[1:].split()[0]
-            else:
-                sequence += line
-        if name:
-            lengths.append(len(sequence))
-    return lengths
-
-
 def load_excluded_assemblies(excluded_assemblies_filename):
     excluded = set()
     print()
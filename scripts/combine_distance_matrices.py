@@ -5,14 +5,23 @@ import sys
 import textwrap
 import numpy as np
 
+from distance_matrix import load_matrix, save_matrix
+
+
+# Matrices are processed in blocks of rows, which keeps the NumPy temporaries small even when the
+# full matrix has tens of thousands of assemblies.
+ROW_BLOCK_SIZE = 256
+
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Combine two different distance matrices')
 
     parser.add_argument('matrix_1', type=str,
-                        help='First PHYLIP distance matrix (better at shorter distances)')
+                        help='First distance matrix, PHYLIP or .npy (better at shorter '
+                             'distances, missing distances can be NaN)')
     parser.add_argument('matrix_2', type=str,
-                        help='Second PHYLIP distance matrix (better at longer distances)')
+                        help='Second distance matrix, PHYLIP or .npy (better at longer '
+                             'distances)')
 
     parser.add_argument('--regression_min', type=float, required=False, default=0.0,
                         help='Lower end of the regression window')
@@ -23,6 +32,12 @@ def get_arguments():
     parser.add_argument('--blend_max', type=float, required=False, default=0.2,
                         help='Upper end of the blend window')
 
+    parser.add_argument('--out', type=str, required=False,
+                        help='Output matrix filename, saved in binary format if it ends in '
+                             '.npy (default: PHYLIP to stdout)')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='Gzip the output matrix (default: only if --out ends in .gz)')
+
     args = parser.parse_args()
     return args
 
@@ -31,86 +46,74 @@ def main():
     args = get_arguments()
     print_intro_message(args.matrix_1, args.matrix_2)
 
-    matrix_1_distances, matrix_1_assemblies = load_distance_matrix(args.matrix_1)
-    matrix_2_distances, matrix_2_assemblies = load_distance_matrix(args.matrix_2)
+    matrix_1, matrix_1_assemblies = load_matrix(args.matrix_1)
+    matrix_2, matrix_2_assemblies = load_matrix(args.matrix_2)
 
     assert matrix_1_assemblies == matrix_2_assemblies
-    assemblies = sorted(matrix_1_assemblies)
+    assemblies, matrix_1, matrix_2 = sort_matrices(matrix_1_assemblies, matrix_1, matrix_2)
 
     # First we do a regression between distances, using an overlapping range where we trust both.
-    slope, intercept = distance_regression(matrix_1_distances, matrix_2_distances, assemblies,
+    slope, intercept = distance_regression(matrix_1, matrix_2,
                                            args.regression_min, args.regression_max,
                                            args.matrix_1, args.matrix_2)
 
     # Then we build a new matrix, using matrix 1 for low distances, matrix 2 for large distances
     # (adjusted using our regression values) and a blended region in between.
-    combined_matrix = build_combined_matrix(matrix_1_distances, matrix_2_distances, assemblies,
+    combined_matrix = build_combined_matrix(matrix_1, matrix_2,
                                             args.blend_min, args.blend_max, slope, intercept)
 
-    print_matrix(combined_matrix, assemblies)
-
-
-def load_distance_matrix(matrix_filename):
-    print('Loading {}'.format(matrix_filename), end=' ', file=sys.stderr, flush=True)
-    assemblies = []
-
-    try:
-        with open(matrix_filename, 'rt') as matrix:
-            assembly_count = int(next(matrix).strip())
-            for line in matrix:
-                assemblies.append(line.split('\t', 1)[0])
-        assert len(assemblies) == assembly_count
-        print('({} assemblies)'.format(assembly_count), end='', file=sys.stderr, flush=True)
-
-        matrix = {}
-        n = 0
-        with open(matrix_filename, 'rt') as matrix_file:
-            next(matrix_file)  # skip the count line
-            for line in matrix_file:
-                parts = line.strip().split('\t')
-                assert len(parts) == assembly_count + 1
-                assembly = parts[0]
-                distances = [float(x) for x in parts[1:]]
-                assert len(distances) == assembly_count
-                matrix[assembly] = dict(zip(assemblies, distances))
-                n += 1
-                if n % 100 == 0:
-                    print('.', end='', file=sys.stderr, flush=True)
-
-        print(' done', file=sys.stderr, flush=True)
-
-    except AssertionError:
-        sys.exit('\nError: failed to load {}\n'
-                 'Is this a valid PHYLIP distance matrix?'.format(matrix_filename))
-
-    return matrix, assemblies
-
-
-def distance_regression(matrix_1_distances, matrix_2_distances, assemblies, regression_min,
-                        regression_max, matrix_1_filename, matrix_2_filename):
+    save_matrix(combined_matrix, assemblies, args.out, args.gzip)
+
+
+def sort_matrices(assemblies, *matrices):
+    """
+    Puts the assemblies (and the rows/columns of each matrix) into sorted order, so the combined
+    matrix is output in the same order regardless of the input order.
+    """
+    order = sorted(range(len(assemblies)), key=lambda i: assemblies[i])
+    if order == list(range(len(assemblies))):
+        return (assemblies,) + matrices
+    sorted_assemblies = [assemblies[i] for i in order]
+    order = np.array(order)
+    sorted_matrices = tuple(m[np.ix_(order, order)] for m in matrices)
+    return (sorted_assemblies,) + sorted_matrices
+
+
+def upper_triangle_blocks(assembly_count):
+    """
+    Yields (start, end, mask) for each block of rows, where the mask selects the cells of
+    matrix[start:end, start:] which are on or above the diagonal.
+    """
+    for start in range(0, assembly_count, ROW_BLOCK_SIZE):
+        end = min(start + ROW_BLOCK_SIZE, assembly_count)
+        rows = np.arange(end - start)[:, np.newaxis]
+        cols = np.arange(assembly_count - start)[np.newaxis, :]
+        yield start, end, cols >= rows
+
+
+def distance_regression(matrix_1, matrix_2, regression_min, regression_max,
+                        matrix_1_filename, matrix_2_filename):
     print('\nPerforming regression:', file=sys.stderr, flush=True)
     print('gathering distances in the range of {} to {} in '
           '{}'.format(regression_min, regression_max, matrix_1_filename),
           end='', file=sys.stderr, flush=True)
     x, y = [], []
-    for i, assembly_1 in enumerate(assemblies):
-        for j in range(i, len(assemblies)):
-            assembly_2 = assemblies[j]
-            m1_distance = matrix_1_distances[assembly_1][assembly_2]
-            assert m1_distance == matrix_1_distances[assembly_2][assembly_1]
-            if regression_min <= m1_distance < regression_max:
-                m2_distance = matrix_2_distances[assembly_1][assembly_2]
-                assert m2_distance == matrix_2_distances[assembly_2][assembly_1]
-                x.append(m2_distance)
-                y.append(m1_distance)
-        if i % 100 == 0:
-            print('.', end='', file=sys.stderr, flush=True)
+    for start, end, upper in upper_triangle_blocks(matrix_1.shape[0]):
+        m1_distances = matrix_1[start:end, start:]
+        m2_distances = matrix_2[start:end, start:]
+        assert np.array_equal(m1_distances[upper], matrix_1[start:, start:end].T[upper],
+                              equal_nan=True)
+        in_window = upper & (m1_distances >= regression_min) & (m1_distances < regression_max)
+        assert np.array_equal(m2_distances[in_window], matrix_2[start:, start:end].T[in_window])
+        x.append(m2_distances[in_window])
+        y.append(m1_distances[in_window])
+        print('.', end='', file=sys.stderr, flush=True)
     print(' done', file=sys.stderr, flush=True)
 
     print('linear regression (x = {} distance, y = {} '
           'distance):'.format(matrix_2_filename, matrix_1_filename), file=sys.stderr, flush=True)
-    x = np.array(x)
-    y = np.array(y)
+    x = np.concatenate(x).astype(np.float64)
+    y = np.concatenate(y).astype(np.float64)
     a = np.vstack([x, np.ones(len(x))]).T
     slope, intercept = np.linalg.lstsq(a, y, rcond=None)[0]
     print('  slope:     {:.6f}'.format(slope), file=sys.stderr, flush=True)
@@ -121,35 +124,29 @@ def distance_regression(matrix_1_distances, matrix_2_distances, assemblies, regr
     return slope, intercept
 
 
-def make_empty_distance_matrix(assemblies):
-    matrix = {}
-    for i in assemblies:
-        matrix[i] = {}
-        for j in assemblies:
-            matrix[i][j] = None
-    return matrix
-
-
-def build_combined_matrix(matrix_1_distances, matrix_2_distances, assemblies, blend_min, blend_max,
-                          slope, intercept):
-    combined_matrix = make_empty_distance_matrix(assemblies)
+def build_combined_matrix(matrix_1, matrix_2, blend_min, blend_max, slope, intercept):
+    combined_matrix = np.empty(matrix_1.shape, dtype=np.float32)
     print('\nBuilding combined matrix', end='', file=sys.stderr, flush=True)
-    for i in range(len(assemblies)):
-        a1 = assemblies[i]
-        for j in range(i, len(assemblies)):
-            a2 = assemblies[j]
-            m1_distance = matrix_1_distances[a1][a2]
-            m2_distance = (matrix_2_distances[a1][a2] * slope) + intercept
-            if m1_distance <= blend_min:
-                distance = m1_distance
-            elif m1_distance >= blend_max:
-                distance = m2_distance
-            else:  # in between blend_min and blend_max
-                distance = blend(m1_distance, m2_distance, blend_min, blend_max)
-            combined_matrix[a1, a2] = distance
-            combined_matrix[a2, a1] = distance
-        if i % 100 == 0:
-            print('.', end='', file=sys.stderr, flush=True)
+    for start, end, upper in upper_triangle_blocks(matrix_1.shape[0]):
+        m1_distances = matrix_1[start:end, start:].astype(np.float64)
+        m2_distances = (matrix_2[start:end, start:].astype(np.float64) * slope) + intercept
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(m1_distances <= blend_min, m1_distances,
+                                 np.where(m1_distances >= blend_max, m2_distances,
+                                          blend(m1_distances, m2_distances,
+                                                blend_min, blend_max)))
+
+        # Missing (NaN) distances in matrix 1, e.g. from a sparse FastANI run which skipped
+        # distant pairs, are taken from matrix 2.
+        distances = np.where(np.isnan(m1_distances), m2_distances, distances)
+
+        # Only the upper triangle is used: each row block fills its part of the upper triangle
+        # and the mirrored part of the lower triangle.
+        combined_matrix[start:end, start:] = distances
+        combined_matrix[start:, start:end] = distances.T
+        square = distances[:, :end - start]
+        combined_matrix[start:end, start:end] = np.where(upper[:, :end - start], square, square.T)
+        print('.', end='', file=sys.stderr, flush=True)
     print(' done', file=sys.stderr, flush=True)
     return combined_matrix
 
@@ -160,19 +157,6 @@ def blend(m1_distance, m2_distance, t2, t3):
     return (m1_weight * m1_distance) + (m2_weight * m2_distance)
 
 
-def print_matrix(matrix, assemblies):
-    print('Printing matrix to stdout', end='', file=sys.stderr, flush=True)
-    print(len(assemblies))
-    for i, a1 in enumerate(assemblies):
-        print(a1, end='')
-        for a2 in assemblies:
-            print('\t%.6f' % matrix[(a1, a2)], end='')
-        print('')
-        if i % 100 == 0:
-            print('.', end='', file=sys.stderr, flush=True)
-    print(' done\n', file=sys.stderr, flush=True)
-
-
 def print_intro_message(m1, m2):
     intro = 'This script will create a distance matrix using a combination of distances from ' \
             '{} and {}. Short distances will come from {} and longer distances from {}, with ' \
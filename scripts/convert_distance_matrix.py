@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This script converts a distance matrix between PHYLIP format and Bacsort's binary format (a .npy
+file with a sidecar .labels file). The format of each file is determined by its extension: files
+ending in .npy are binary and anything else is PHYLIP. This is useful for turning Mash's PHYLIP
+matrix into a binary one before combining, and for exporting a binary matrix to PHYLIP for
+tree-building tools.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+
+from distance_matrix import load_matrix, save_matrix
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Convert between PHYLIP and binary distance '
+                                                 'matrices')
+
+    parser.add_argument('input', type=str,
+                        help='Input distance matrix (PHYLIP or .npy)')
+    parser.add_argument('output', type=str,
+                        help='Output distance matrix (PHYLIP or .npy)')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_arguments()
+    matrix, labels = load_matrix(args.input)
+    save_matrix(matrix, labels, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,8 @@ import os
 import pathlib
 import shutil
 
+from species_index import load_accession_species
+
 
 def main():
     cluster_accessions = load_cluster_accessions()
@@ -61,68 +63,5 @@ def load_cluster_accessions():
     return cluster_accessions
 
 
-def load_accession_species():
-    accession_species = {}
-
-    # Load from NCBI metadata first...
-    data_files = [str(x) for x in pathlib.Path.cwd().glob('assemblies/*/data.tsv')]
-    for data_file in data_files:
-        with open(data_file, 'rt') as data:
-            for line in data:
-                parts = line.split('\t')
-                if parts[0] == 'assembly_accession':
-                    continue
-                accession = parts[0][:13]
-                species = parts[9]
-                species_parts = species.split(' ')[0:2]
-
-                # Some 'species names' aren't really species names.
-                if species_parts[1] == 'sp.':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'bacterium':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'symbiont':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'endosymbiont':
-                    species_parts[1] = 'unknown'
-
-                species = ' '.join(species_parts)
-                accession_species[accession] = species
-
-    # ...and then load from the user-defined file, so they can overwrite NCBI species.
-    if pathlib.Path('species_definitions').is_file():
-        with open('species_definitions', 'rt') as user_species:
-            for line in user_species:
-                if not line.startswith('GCF'):
-                    continue
-                parts = line.strip().split('\t')
-                if parts[0] == 'Accession':
-                    continue
-                if len(parts) < 2:
-                    continue
-                accession, species = parts[0][:13], parts[1]
-                accession_species[accession] = species
-
-    # If the user-defined file doesn't exist yet, make an empty one with instructions.
-    else:
-        with open('species_definitions', 'wt') as user_species:
-            t = '# This file is where you can define species for particular RefSeq assemblies,\n' \
-                '# overriding the RefSeq species labels. Simply add lines to this file which\n' \
-                '# have the RefSeq assembly accession (starts with GCF) followed by a tab and\n' \
-                '# then the binomial species name. The version number (e.g. final .1) does not\n' \
-                'need to be included in the accession.\n' \
-                '\n' \
-                '# Example:\n' \
-                'GCF_000000000	Genus species\n'
-            user_species.write(t)
-
-    # Shigella and E. coli are grouped together.
-    for accession, species in accession_species.items():
-        if species == 'Escherichia coli' or species.startswith('Shigella '):
-            accession_species[accession] = 'Escherichia coli / Shigella'
-
-    return accession_species
-
-
 if __name__ == '__main__':
     main()
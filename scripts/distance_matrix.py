@@ -0,0 +1,183 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module contains functions for loading and saving distance matrices which are shared by
+Bacsort's Python scripts. Matrices are held as float32 NumPy arrays with a separate list of labels.
+
+Matrices can be stored either as PHYLIP text or as a binary .npy file with a sidecar .labels file
+(one label per line). The binary format is much faster to load (it is memory-mapped, not parsed)
+and is intended for passing matrices between Bacsort's stages. PHYLIP is only needed for the
+final hand-off to a tree-building tool.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import gzip
+import io
+import sys
+import numpy as np
+
+
+# Formatted rows are collected in memory and written out once they add up to this many characters,
+# so the output is written in a small number of large blocks.
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def load_matrix(matrix_filename):
+    """
+    Loads a matrix in either format, using the filename extension to tell them apart.
+    """
+    if is_binary_matrix_filename(matrix_filename):
+        return load_binary_matrix(matrix_filename)
+    else:
+        return load_phylip_matrix(matrix_filename)
+
+
+def save_matrix(matrix, labels, out_filename=None, gzip_output=None):
+    """
+    Saves a matrix in either format, using the filename extension to choose. Binary matrices
+    cannot go to stdout or be gzipped.
+    """
+    if out_filename is not None and is_binary_matrix_filename(out_filename):
+        if gzip_output:
+            sys.exit('Error: binary matrices cannot be gzipped')
+        save_binary_matrix(matrix, labels, out_filename)
+    else:
+        save_phylip_matrix(matrix, labels, out_filename, gzip_output)
+
+
+def is_binary_matrix_filename(matrix_filename):
+    return matrix_filename.endswith('.npy')
+
+
+def get_labels_filename(matrix_filename):
+    assert is_binary_matrix_filename(matrix_filename)
+    return matrix_filename[:-4] + '.labels'
+
+
+def load_binary_matrix(matrix_filename):
+    """
+    Opens a .npy matrix as a read-only memory map, so rows are only read from disk when they are
+    used.
+    """
+    print('Loading {}'.format(matrix_filename), end=' ', file=sys.stderr, flush=True)
+    labels_filename = get_labels_filename(matrix_filename)
+    try:
+        with open(labels_filename, 'rt') as labels_file:
+            labels = [line.rstrip('\r\n') for line in labels_file]
+        matrix = np.load(matrix_filename, mmap_mode='r')
+        assert matrix.dtype == np.float32
+        assert matrix.shape == (len(labels), len(labels))
+    except (AssertionError, ValueError, OSError):
+        sys.exit('\nError: failed to load {} and {}\n'
+                 'Is this a valid binary distance matrix?'.format(matrix_filename,
+                                                                  labels_filename))
+    print('({} assemblies) done'.format(len(labels)), file=sys.stderr, flush=True)
+    return matrix, labels
+
+
+def save_binary_matrix(matrix, labels, out_filename):
+    print('Saving matrix to {}'.format(out_filename), end='', file=sys.stderr, flush=True)
+    assert matrix.shape == (len(labels), len(labels))
+    np.save(out_filename, np.asarray(matrix, dtype=np.float32))
+    with open(get_labels_filename(out_filename), 'wt') as labels_file:
+        for label in labels:
+            labels_file.write(label)
+            labels_file.write('\n')
+    print(' done\n', file=sys.stderr, flush=True)
+
+
+def load_phylip_matrix(matrix_filename):
+    print('Loading {}'.format(matrix_filename), end=' ', file=sys.stderr, flush=True)
+    labels = []
+
+    try:
+        with open_text_file(matrix_filename, 'rt') as matrix_file:
+            label_count = int(next(matrix_file).strip())
+            print('({} assemblies)'.format(label_count), end='', file=sys.stderr, flush=True)
+            matrix = np.empty((label_count, label_count), dtype=np.float32)
+            for line in matrix_file:
+                parts = line.rstrip('\r\n').split('\t', 1)
+                assert len(parts) == 2
+                assert len(labels) < label_count
+                distances = np.fromstring(parts[1], dtype=np.float32, sep='\t')
+                assert len(distances) == label_count
+                matrix[len(labels)] = distances
+                labels.append(parts[0])
+                if len(labels) % 100 == 0:
+                    print('.', end='', file=sys.stderr, flush=True)
+        assert len(labels) == label_count
+        print(' done', file=sys.stderr, flush=True)
+
+    except (AssertionError, ValueError, StopIteration):
+        sys.exit('\nError: failed to load {}\n'
+                 'Is this a valid PHYLIP distance matrix?'.format(matrix_filename))
+
+    return matrix, labels
+
+
+def save_phylip_matrix(matrix, labels, out_filename=None, gzip_output=None):
+    """
+    Writes the matrix in PHYLIP format, to stdout if no filename is given. Each row is formatted
+    with a single % operation and rows are written in large blocks. If gzip_output is None, the
+    output is gzipped when the filename ends in .gz.
+    """
+    if gzip_output is None:
+        gzip_output = out_filename is not None and out_filename.endswith('.gz')
+    if out_filename is None:
+        print('Printing matrix to stdout', end='', file=sys.stderr, flush=True)
+    else:
+        print('Saving matrix to {}'.format(out_filename), end='', file=sys.stderr, flush=True)
+
+    label_count = len(labels)
+    row_format = '%s' + ('\t%.6f' * label_count) + '\n'
+    buffer = io.StringIO()
+    with open_output(out_filename, gzip_output) as out:
+        buffer.write('{}\n'.format(label_count))
+        for i, label in enumerate(labels):
+            buffer.write(row_format % (label, *matrix[i].tolist()))
+            if buffer.tell() >= WRITE_BUFFER_SIZE:
+                flush_buffer(buffer, out)
+            if i % 100 == 0:
+                print('.', end='', file=sys.stderr, flush=True)
+        flush_buffer(buffer, out)
+    print(' done\n', file=sys.stderr, flush=True)
+
+
+def flush_buffer(buffer, out):
+    out.write(buffer.getvalue())
+    buffer.seek(0)
+    buffer.truncate()
+
+
+@contextlib.contextmanager
+def open_output(out_filename, gzip_output=False):
+    """
+    Yields an output text stream: stdout if no filename is given, otherwise a plain or gzipped
+    file. Stdout is flushed but not closed on exit.
+    """
+    if out_filename is None:
+        yield sys.stdout
+        sys.stdout.flush()
+    elif gzip_output:
+        with gzip.open(out_filename, 'wt', compresslevel=6) as out:
+            yield out
+    else:
+        with open(out_filename, 'wt', buffering=WRITE_BUFFER_SIZE) as out:
+            yield out
+
+
+def open_text_file(filename, mode='rt'):
+    with open(filename, 'rb') as f:
+        is_gzipped = f.read(2) == b'\x1f\x8b'
+    if is_gzipped:
+        return gzip.open(filename, mode)
+    return open(filename, mode)
@@ -5,7 +5,9 @@
 
 # This script is the first step of Bacsort. It takes a single argument: a space-delimited list
 # of genera. When run, it downloads assemblies from NCBI with their metadata (including the
-# species). It then uses Mash to do pairwise distances between all assemblies in each genus.
+# species). It then uses Mash to do pairwise distances between all assemblies in each genus. If a
+# genus has already been downloaded and sketched, only the new assemblies are sketched and their
+# distances are appended to the existing ones.
 
 # This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 # under the terms of the GNU General Public License as published by the Free Software Foundation,
@@ -25,10 +27,12 @@ echo "Checking for Mash"
 echo "------------------------------------------------"
 if command -v mash; then
     echo "Mash found!"
+    use_mash=true
 else
-    echo "Error: could not find mash"
-    echo "install from https://github.com/marbl/Mash"
-    exit 1
+    # Without Mash, no distances are computed here: cluster_genera.py --sketch computes them
+    # in-process instead.
+    echo "Could not find mash - skipping pairwise distances (use cluster_genera.py --sketch)"
+    use_mash=false
 fi
 printf "\n"
 
@@ -76,10 +80,36 @@ for genus in $genera; do
         rm -r refseq
         printf "\n\n"
 
-        echo "Finding pairwise distances for "$genus
-        echo "------------------------------------------------"
-        mash sketch -p $threads -o mash -s $mash_sketch_size *.fna.gz
-        mash dist -p $threads mash.msh mash.msh > mash_distances
+        if $use_mash; then
+            echo "Finding pairwise distances for "$genus
+            echo "------------------------------------------------"
+            ls *.fna.gz | sort > all_assemblies
+            if [ -f mash.msh ] && [ -f mash_distances ] && [ -f sketched_assemblies ]; then
+                # This genus has been done before, so we only sketch the new assemblies and append
+                # their distances (new vs all and all vs new) to the existing distances. Run
+                # cluster_genera.py with --incremental to extend the existing clusters.
+                comm -13 sketched_assemblies all_assemblies > new_assemblies
+                if [ -s new_assemblies ]; then
+                    echo $(wc -l < new_assemblies)" new assemblies"
+                    mash sketch -p $threads -o new -s $mash_sketch_size -l new_assemblies
+                    mash paste combined mash.msh new.msh
+                    mash dist -p $threads combined.msh new.msh >> mash_distances
+                    mash dist -p $threads new.msh mash.msh >> mash_distances
+                    mv combined.msh mash.msh
+                    rm new.msh
+                else
+                    echo "No new assemblies"
+                fi
+                rm new_assemblies
+            else
+                # The distances are rewritten from scratch, so any saved clustering progress
+                # through the old file no longer applies.
+                rm -f clustering_state.tsv
+                mash sketch -p $threads -o mash -s $mash_sketch_size *.fna.gz
+                mash dist -p $threads mash.msh mash.msh > mash_distances
+            fi
+            mv all_assemblies sketched_assemblies
+        fi
         cd ../..
     else
         echo "No assemblies downloaded for "$genus
@@ -4,7 +4,7 @@
 # https://github.com/rrwick/Bacsort
 
 # This script is the third step of Bacsort. It takes no arguments. When run, it uses FastANI to
-# build a distance matrix between all assemblies.
+# find pairwise distances between all assemblies, stored in tree/fastani.db.
 
 # This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 # under the terms of the GNU General Public License as published by the Free Software Foundation,
@@ -14,14 +14,6 @@
 # more details. You should have received a copy of the GNU General Public License along with
 # Bacsort. If not, see <http://www.gnu.org/licenses/>.
 
-threads=32
-
-mkdir -p tree
-
-printf "\n"
-echo "Find pairwise distances with FastANI"
-echo "------------------------------------------------"
-cd clusters
-ls *.fna.gz > cluster_list
-
-fastANI --rl cluster_list --ql cluster_list -o ../tree/fastani_output
+# The FastANI step is run by run_fastani.py, which keeps results in tree/fastani.db so only pairs
+# involving new or changed clusters are run.
+run_fastani.py --threads 1
@@ -0,0 +1,450 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module schedules all-vs-all FastANI runs. The query and reference clusters are each split
+into groups of similar total genome size, and each (query group, reference group) block is one
+FastANI run, written as a small shell script in a work directory. When the query and reference
+clusters are the same, only the upper triangle of blocks (including the diagonal) can be run, so
+each pair is only computed in one direction. A sparse plan only covers a given set of pairs
+(e.g. those which are close according to Mash): clusters are grouped in name order (so clusters
+of the same genus tend to share a group) and each block only includes the clusters which have a
+pair in it. When a block's script finishes,
+it writes FastANI's exit status to a status file.
+
+The scripts can be run by interchangeable backends:
+  * LocalBackend: a bounded pool of local workers, each taking the next block as soon as it is
+    free, so one slow block doesn't hold up the others.
+  * SlurmBackend: Slurm array jobs, with one array task per block (split into several arrays
+    if there are more blocks than Slurm's MaxArraySize allows).
+  * CommandBackend: any submit command (e.g. for another scheduler), run once per block script.
+Whatever the backend, this process watches for status files, retries failed blocks and merges
+finished blocks: their output is appended to the merged FastANI output file and added to the
+FastANI result store. Only this process writes to the store, so jobs on other nodes don't need
+to lock it.
+
+The block plan and the list of completed blocks are saved in the work directory, so an
+interrupted run can be resumed without repeating completed blocks. The Slurm backend also saves
+the job ID of each block's array task, so a resumed run waits for blocks which are still queued
+or running instead of submitting them again (two runs of one block would write the same files).
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import concurrent.futures
+import getpass
+import heapq
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from ani_store import get_assembly_ids, add_fastani_results
+
+
+PLAN_FILENAME = 'plan.tsv'
+COMPLETED_FILENAME = 'completed'
+SLURM_JOBS_FILENAME = 'slurm_jobs.tsv'
+
+Block = collections.namedtuple('Block', ['name', 'query_list', 'reference_list'])
+
+
+def partition_by_size(cluster_files, group_count):
+    """
+    Splits the cluster files into (at most) group_count groups with similar total file sizes,
+    by giving each file (largest first) to the group with the smallest total so far.
+    """
+    group_count = max(1, min(group_count, len(cluster_files)))
+    sizes = sorted(((os.path.getsize(f), f) for f in cluster_files), reverse=True)
+    heap = [(0, i) for i in range(group_count)]
+    groups = [[] for _ in range(group_count)]
+    for size, cluster_file in sizes:
+        total, i = heapq.heappop(heap)
+        groups[i].append(cluster_file)
+        heapq.heappush(heap, (total + size, i))
+    return [sorted(g) for g in groups if g]
+
+
+def make_block_plan(work_dir, block_sets):
+    """
+    Writes the list files and plan for a new run. block_sets is a list of (query files,
+    reference files, query group count, reference group count, triangle), where every query
+    group is run against every reference group. If triangle is set, the queries and references
+    must be the same and they share one set of groups, where group i is only run against groups
+    i and above.
+    """
+    make_empty_dir(work_dir)
+    blocks = []
+    for set_num, (queries, references, query_group_count,
+                  reference_group_count, triangle) in enumerate(block_sets):
+        query_lists = write_group_lists(work_dir, 'set{}_query'.format(set_num),
+                                        partition_by_size(queries, query_group_count))
+        if triangle:
+            assert queries == references
+            reference_lists = query_lists
+        else:
+            reference_lists = write_group_lists(work_dir, 'set{}_reference'.format(set_num),
+                                                partition_by_size(references,
+                                                                  reference_group_count))
+        for q_num, query_list in enumerate(query_lists):
+            for r_num, reference_list in enumerate(reference_lists):
+                if triangle and r_num < q_num:
+                    continue
+                name = 'set{}_{:04d}_{:04d}'.format(set_num, q_num, r_num)
+                blocks.append(Block(name, query_list, reference_list))
+    save_block_plan(work_dir, blocks)
+    return blocks
+
+
+def make_sparse_block_plan(work_dir, cluster_files, group_count, pairs, reciprocal):
+    """
+    Writes the list files and plan for a new run which covers the given (query file, reference
+    file) pairs. Each block's lists only contain the clusters with a pair in that block, so blocks
+    with no pairs are skipped entirely. Unless reciprocal is set, each pair is only run in one
+    direction.
+    """
+    make_empty_dir(work_dir)
+    groups = partition_in_order(cluster_files, group_count)
+    group_nums = {f: i for i, group in enumerate(groups) for f in group}
+    block_pairs = collections.defaultdict(list)
+    for query, reference in pairs:
+        q_num, r_num = group_nums[query], group_nums[reference]
+        if not reciprocal and r_num < q_num:
+            query, reference, q_num, r_num = reference, query, r_num, q_num
+        block_pairs[(q_num, r_num)].append((query, reference))
+        if reciprocal:
+            block_pairs[(r_num, q_num)].append((reference, query))
+    blocks = []
+    for q_num, r_num in sorted(block_pairs):
+        name = 'sparse_{:04d}_{:04d}'.format(q_num, r_num)
+        queries = sorted(set(q for q, _ in block_pairs[(q_num, r_num)]))
+        references = sorted(set(r for _, r in block_pairs[(q_num, r_num)]))
+        query_list = write_group_lists(work_dir, name + '_query', [queries])[0]
+        reference_list = write_group_lists(work_dir, name + '_reference', [references])[0]
+        blocks.append(Block(name, query_list, reference_list))
+    save_block_plan(work_dir, blocks)
+    return blocks
+
+
+def partition_in_order(cluster_files, group_count):
+    """
+    Splits the (sorted) cluster files into (at most) group_count consecutive groups with similar
+    total file sizes.
+    """
+    sizes = [os.path.getsize(f) for f in cluster_files]
+    target_size = sum(sizes) / max(1, group_count)
+    groups, group, group_size = [], [], 0
+    for cluster_file, size in zip(cluster_files, sizes):
+        if group and group_size + size / 2 > target_size * (len(groups) + 1):
+            groups.append(group)
+            group = []
+        group.append(cluster_file)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+def make_empty_dir(work_dir):
+    if pathlib.Path(work_dir).is_dir():
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+
+def save_block_plan(work_dir, blocks):
+    with open(os.path.join(work_dir, PLAN_FILENAME), 'wt') as plan_file:
+        for block in blocks:
+            plan_file.write('\t'.join(block) + '\n')
+
+
+def write_group_lists(work_dir, prefix, groups):
+    list_filenames = []
+    for i, group in enumerate(groups):
+        list_filename = os.path.abspath(os.path.join(work_dir, '{}_{:04d}'.format(prefix, i)))
+        with open(list_filename, 'wt') as list_file:
+            for cluster_file in group:
+                list_file.write(os.path.basename(cluster_file) + '\n')
+        list_filenames.append(list_filename)
+    return list_filenames
+
+
+def load_block_plan(work_dir):
+    """
+    Returns the saved blocks and the names of the completed ones, or None if there is no saved
+    plan to resume.
+    """
+    plan_filename = os.path.join(work_dir, PLAN_FILENAME)
+    if not pathlib.Path(plan_filename).is_file():
+        return None
+    with open(plan_filename, 'rt') as plan_file:
+        blocks = [Block(*line.rstrip('\n').split('\t')) for line in plan_file if line.strip()]
+    completed = set()
+    completed_filename = os.path.join(work_dir, COMPLETED_FILENAME)
+    if pathlib.Path(completed_filename).is_file():
+        with open(completed_filename, 'rt') as completed_file:
+            completed = set(line.strip() for line in completed_file if line.strip())
+    return blocks, completed
+
+
+def mark_block_complete(work_dir, block):
+    with open(os.path.join(work_dir, COMPLETED_FILENAME), 'at') as completed_file:
+        completed_file.write(block.name + '\n')
+        completed_file.flush()
+        os.fsync(completed_file.fileno())
+
+
+def get_block_output_filename(work_dir, block):
+    return os.path.abspath(os.path.join(work_dir, block.name + '.out'))
+
+
+def get_block_status_filename(work_dir, block):
+    return os.path.abspath(os.path.join(work_dir, block.name + '.status'))
+
+
+def write_block_script(block, clusters_dir, work_dir):
+    """
+    Writes the shell script which runs FastANI for one block (in the clusters directory, so the
+    output uses cluster filenames) and returns its path. The status file is written last, via a
+    rename, so it only appears once the output is complete. The script itself is also replaced
+    via a rename, as a job from an earlier run may be about to start it.
+    """
+    script_filename = os.path.abspath(os.path.join(work_dir, block.name + '.sh'))
+    status_filename = get_block_status_filename(work_dir, block)
+    with open(script_filename + '.tmp', 'wt') as script:
+        script.write('#!/usr/bin/env bash\n')
+        script.write('cd {}\n'.format(shlex.quote(clusters_dir)))
+        script.write('fastANI --ql {} --rl {} -o {} > {} 2>&1\n'.format(
+            shlex.quote(block.query_list), shlex.quote(block.reference_list),
+            shlex.quote(get_block_output_filename(work_dir, block)),
+            shlex.quote(os.path.join(os.path.abspath(work_dir), block.name + '.log'))))
+        script.write('echo $? > {}.tmp\n'.format(shlex.quote(status_filename)))
+        script.write('mv {0}.tmp {0}\n'.format(shlex.quote(status_filename)))
+    os.replace(script_filename + '.tmp', script_filename)
+    return script_filename
+
+
+def get_block_status(work_dir, block):
+    """
+    Returns FastANI's exit status for the block, or None if the block hasn't finished.
+    """
+    try:
+        with open(get_block_status_filename(work_dir, block), 'rt') as status_file:
+            return int(status_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def clear_block_files(work_dir, block):
+    for filename in (get_block_output_filename(work_dir, block),
+                     get_block_status_filename(work_dir, block)):
+        if pathlib.Path(filename).is_file():
+            os.remove(filename)
+
+
+class LocalBackend(object):
+    """
+    Runs block scripts with a pool of local worker threads (each one waits on a FastANI process).
+    """
+    poll_interval = 1
+
+    def __init__(self, threads):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, scripts):
+        for script in scripts:
+            self.executor.submit(subprocess.run, ['bash', script])
+
+    def get_active_scripts(self):
+        # Local workers don't outlive the process which started them.
+        return set()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class SlurmBackend(object):
+    """
+    Submits block scripts as Slurm array jobs (one task per script), each with at most max_array
+    tasks: Slurm rejects arrays with indices of MaxArraySize or more. Each task's job ID is saved
+    with its script, so the scripts still queued or running (e.g. from an interrupted run) can be
+    found with squeue. The work directory must be on a filesystem shared with the compute nodes.
+    """
+    poll_interval = 30
+
+    def __init__(self, work_dir, slurm_options, max_array):
+        self.work_dir = os.path.abspath(work_dir)
+        self.slurm_options = shlex.split(slurm_options)
+        self.max_array = max_array
+
+        # A resumed run numbers its array scripts after those of the earlier run.
+        self.array_count = len(list(pathlib.Path(self.work_dir).glob('array_*.sh')))
+
+    def submit(self, scripts):
+        for i in range(0, len(scripts), self.max_array):
+            self.submit_array(scripts[i:i + self.max_array])
+
+    def submit_array(self, scripts):
+        array_filename = os.path.join(self.work_dir, 'array_{:04d}.sh'.format(self.array_count))
+        self.array_count += 1
+        with open(array_filename, 'wt') as array_script:
+            array_script.write('#!/usr/bin/env bash\n')
+            array_script.write('scripts=({})\n'.format(' '.join(shlex.quote(s)
+                                                                for s in scripts)))
+            array_script.write('bash "${scripts[$SLURM_ARRAY_TASK_ID]}"\n')
+        sbatch_output = run_submit_command(['sbatch', '--parsable', '--job-name=fastANI',
+                                            '--array=0-{}'.format(len(scripts) - 1),
+                                            '--output=' + os.path.join(self.work_dir,
+                                                                       'slurm_%A_%a.out')] +
+                                           self.slurm_options + [array_filename])
+        job_id = sbatch_output.strip().split(';')[0]
+        with open(os.path.join(self.work_dir, SLURM_JOBS_FILENAME), 'at') as jobs_file:
+            for i, script in enumerate(scripts):
+                jobs_file.write('{}_{}\t{}\n'.format(job_id, i, script))
+            jobs_file.flush()
+            os.fsync(jobs_file.fileno())
+
+    def get_active_scripts(self):
+        """
+        Returns the scripts whose array tasks are still queued or running, according to squeue.
+        """
+        jobs_filename = os.path.join(self.work_dir, SLURM_JOBS_FILENAME)
+        if not pathlib.Path(jobs_filename).is_file():
+            return set()
+        with open(jobs_filename, 'rt') as jobs_file:
+            task_scripts = [line.rstrip('\n').split('\t') for line in jobs_file if '\t' in line]
+        command = ['squeue', '--noheader', '--array', '--format=%i', '--user=' + getpass.getuser()]
+        try:
+            squeue_output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                           universal_newlines=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            sys.exit('Error: could not check for queued Slurm jobs ({})'.format(e))
+        active_tasks = set(squeue_output.split())
+        return set(script for task, script in task_scripts if task in active_tasks)
+
+    def close(self):
+        pass
+
+
+class CommandBackend(object):
+    """
+    Submits each block script with a user-supplied command, where {script} is replaced by the
+    script's path (e.g. 'qsub -cwd {script}'). The command should return once the job is queued.
+    """
+    poll_interval = 10
+
+    def __init__(self, submit_command):
+        if '{script}' not in submit_command:
+            sys.exit('Error: the submit command must contain {script}')
+        self.submit_command = submit_command
+
+    def submit(self, scripts):
+        for script in scripts:
+            run_submit_command(shlex.split(self.submit_command.replace('{script}',
+                                                                      shlex.quote(script))))
+
+    def get_active_scripts(self):
+        # Jobs submitted with an arbitrary command can't be looked up.
+        return set()
+
+    def close(self):
+        pass
+
+
+def run_submit_command(command):
+    """
+    Runs a job submission command and returns its output.
+    """
+    try:
+        return subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.exit('Error: job submission failed ({})'.format(e))
+
+
+def run_blocks(blocks, backend, clusters_dir, work_dir, finish_block, retries):
+    """
+    Runs the blocks with the given backend and waits for them, calling finish_block (in this
+    process) as each one succeeds. Failed blocks are resubmitted up to the given number of times.
+    Blocks which already have a status (they finished while no driver was watching) are not
+    submitted again, nor are blocks whose jobs the backend reports as still queued or running
+    (their output would be cleared and written twice). Returns the blocks which still failed.
+    """
+    scripts = {block.name: write_block_script(block, clusters_dir, work_dir) for block in blocks}
+    active_scripts = backend.get_active_scripts()
+    attempts = collections.Counter()
+    waiting = {}
+    to_submit = []
+    for block in blocks:
+        if scripts[block.name] in active_scripts:
+            attempts[block.name] += 1
+            waiting[block.name] = block
+        elif get_block_status(work_dir, block) is None:
+            to_submit.append(block)
+        else:
+            waiting[block.name] = block
+    failed = []
+    while to_submit or waiting:
+        if to_submit:
+            for block in to_submit:
+                clear_block_files(work_dir, block)
+                attempts[block.name] += 1
+                waiting[block.name] = block
+            backend.submit([scripts[block.name] for block in to_submit])
+            to_submit = []
+        finished = [(block, get_block_status(work_dir, block)) for block in waiting.values()]
+        finished = [(block, status) for block, status in finished if status is not None]
+        if not finished:
+            time.sleep(backend.poll_interval)
+            continue
+        for block, status in finished:
+            del waiting[block.name]
+            if status == 0:
+                finish_block(block)
+            elif attempts[block.name] <= retries:
+                print('FastANI failed for block {}, retrying'.format(block.name), flush=True)
+                to_submit.append(block)
+            else:
+                print('FastANI failed for block {}'.format(block.name), flush=True)
+                failed.append(block)
+    backend.close()
+    return failed
+
+
+def merge_block_output(block, work_dir, clusters_dir, merged_output, connection):
+    """
+    Appends a finished block's output to the merged output file, adds it to the result store,
+    records the block as complete and deletes its output.
+    """
+    output_filename = get_block_output_filename(work_dir, block)
+    if not pathlib.Path(output_filename).is_file():  # FastANI found no matches at all
+        lines = []
+    else:
+        with open(output_filename, 'rt') as output:
+            lines = output.readlines()
+    merged_output.writelines(lines)
+    merged_output.flush()
+
+    query_ids = get_list_assembly_ids(connection, block.query_list, clusters_dir)
+    reference_ids = get_list_assembly_ids(connection, block.reference_list, clusters_dir)
+    add_fastani_results(connection, query_ids, reference_ids, lines)
+
+    mark_block_complete(work_dir, block)
+    clear_block_files(work_dir, block)
+
+
+def get_list_assembly_ids(connection, list_filename, clusters_dir):
+    with open(list_filename, 'rt') as list_file:
+        names = [line.strip() for line in list_file if line.strip()]
+    paths = {name: os.path.join(clusters_dir, name) for name in names}
+    path_ids = get_assembly_ids(connection, paths.values())
+    return {name: path_ids[path] for name, path in paths.items()}
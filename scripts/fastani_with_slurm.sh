@@ -3,8 +3,8 @@
 # Copyright 2018 Ryan Wick (rrwick@gmail.com)
 # https://github.com/rrwick/Bacsort
 
-# This script is the third step of Bacsort. It takes no arguments. When run, it uses FastANI to
-# build a distance matrix between all assemblies.
+# This script is the third step of Bacsort. It takes no arguments. When run, it submits Slurm jobs
+# which use FastANI to find pairwise distances between all assemblies, stored in tree/fastani.db.
 
 # This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 # under the terms of the GNU General Public License as published by the Free Software Foundation,
@@ -14,28 +14,8 @@
 # more details. You should have received a copy of the GNU General Public License along with
 # Bacsort. If not, see <http://www.gnu.org/licenses/>.
 
-group_count=32
-
-mkdir -p tree
-
-printf "\n"
-echo "Find pairwise distances with FastANI"
-echo "------------------------------------------------"
-cd clusters
-ls *.fna.gz > cluster_list
-
-total_count=$( wc -l < cluster_list )
-count_per_file=$( perl -w -e "use POSIX; print ceil($total_count/$group_count), qq{\n}" )
-cat cluster_list | shuf > split.tmp
-split -a 4 -dl $count_per_file split.tmp cluster_list_
-rm split.tmp
-
-for q in cluster_list_*; do
-    q_num=$(echo $q | sed 's/cluster_list_//')
-    for r in cluster_list_*; do
-        r_num=$(echo $r | sed 's/cluster_list_//')
-        sbatch --nodes=1 --job-name=fastANI_"$q_num"_"$r_num" --ntasks=1 --cpus-per-task=1 --mem=4096 --time=0-24:0:00 --wrap "fastANI --rl "$r" --ql "$q" -o ../tree/fastani_output_"$q_num"_"$r_num" &> ../tree/fastani_stdout_"$q_num"_"$r_num
-    done
-done
-
-cd ..
+# The FastANI step is run by run_fastani.py, which submits the blocks as a Slurm array job, waits
+# for them (retrying any which fail) and merges their results into tree/fastani.db and
+# tree/fastani_output. Keep it running (e.g. in a screen session or its own job) until it
+# finishes. If it is interrupted, run this script again to resume.
+run_fastani.py --backend slurm --groups 32
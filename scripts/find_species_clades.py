@@ -3,10 +3,15 @@
 Copyright 2018 Ryan Wick (rrwick@gmail.com)
 https://github.com/rrwick/Bacsort
 
-This script is the fourth step of Bacsort. It takes no arguments. When run, it loads the tree
-and searches for clades which best describe each species. It outputs to stdout the best clade for
-each species, in order of best to worst. It also saves to file the tree with species clades
-coloured for viewing in Archaeopteryx.
+This script is the fourth step of Bacsort. When run, it loads the tree and searches for clades
+which best describe each species. It outputs to stdout the best clade for each species, in order of
+best to worst. It also saves to file the tree with species clades coloured for viewing in
+Archaeopteryx.
+
+With --watch, it then keeps running as a curation session: the tree and NCBI metadata stay loaded
+and species_definitions is checked for changes every second. Each time it is saved, only the
+species whose labels changed are rescored, their new clades are printed and the tree files are
+rewritten, which takes well under a second rather than reloading everything.
 
 This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 under the terms of the GNU General Public License as published by the Free Software Foundation,
@@ -17,199 +22,281 @@ details. You should have received a copy of the GNU General Public License along
 not, see <http://www.gnu.org/licenses/>.
 """
 
-from Bio import Phylo
-import pathlib
+import argparse
 import collections
+import os
 import random
 import sys
+import time
+import numpy as np
 
+from phylo_tree import read_newick, root_at_midpoint, write_newick, write_phyloxml, \
+    get_subtree_sizes, get_name, set_name
+from species_index import load_ncbi_species, apply_species_definitions
 
-def main():
-    cluster_accessions = load_cluster_accessions()
-    accession_species = load_accession_species()
-
-    tree = Phylo.read('tree/tree.newick', 'newick')
-    tree = tree.as_phyloxml()
-    tree.root_at_midpoint()
-
-    for clade in tree.find_clades():
-        if clade.name is None:
-            continue
-        cluster_name = clade.name.split('.fna.gz')[0]
-        accessions = cluster_accessions[cluster_name]
-        species = [accession_species[a] for a in accessions]
-        species_counts = collections.Counter(species)
-        formatted_species_counts = []
-        for species, count in sorted(species_counts.items(), key=lambda x: (1 / x[1], x[0])):
-            formatted_species_counts.append(str(count) + ' x ' + species)
-        formatted_species_counts = ', '.join(formatted_species_counts)
-        clade.name = cluster_name + ' (' + formatted_species_counts + ')'
 
-    cluster_accessions = load_cluster_accessions()
+# In --watch mode, species_definitions is checked for changes this often (in seconds).
+WATCH_INTERVAL = 1.0
 
-    all_tip_names = get_tip_names(tree.root)
-    all_species_counts = get_species_counts_from_tip_names(all_tip_names)
-    all_species_names = sorted(all_species_counts.keys())
 
-    best_scores = {s: 0.0 for s in all_species_names
-                   if not s.endswith(' unknown')}
-    best_clades = {}
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Find the clades which best describe each '
+                                                 'species in the tree')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running after the first results, rescoring the species whose '
+                             'labels change each time species_definitions is saved')
+    args = parser.parse_args()
+    return args
 
-    for clade in tree.find_clades():
-        tip_names = get_tip_names(clade)
-        species_counts = get_species_counts_from_tip_names(tip_names)
-        for species in species_counts:
-            if species.endswith(' unknown'):
-                continue
-            score = score_clade_for_species(species, species_counts, all_species_counts)
-            if score > best_scores[species]:
-                best_scores[species] = score
-                best_clades[species] = clade
-
-    species_by_score = []
-    for species, clade in best_clades.items():
-        tip_names = get_tip_names(clade)
-        cluster_names = [x.split()[0] for x in tip_names]
-        score = best_scores[species]
-        accessions = []
-        for cluster_name in cluster_names:
-            accessions += cluster_accessions[cluster_name]
-        species_by_score.append((species, score, accessions, clade))
-    species_by_score = sorted(species_by_score, reverse=True, key=lambda x: (x[1], len(x[2])))
-
-    for species, score, accessions, clade in species_by_score:
+
+def main():
+    args = get_arguments()
+    cluster_accessions = load_cluster_accessions()
+    ncbi_species = load_ncbi_species()
+    accession_species = apply_species_definitions(ncbi_species)
+
+    tree = root_at_midpoint(read_newick('tree/tree.newick'))
+    subtree_sizes = get_subtree_sizes(tree.parents)
+    tip_clusters = {i: get_name(tree, i).split('.fna.gz')[0]
+                    for i in np.flatnonzero(tree.name_ids >= 0).tolist()}
+    tip_species_counts = {i: get_species_counts(cluster_accessions[cluster_name],
+                                                accession_species)
+                          for i, cluster_name in tip_clusters.items()}
+
+    all_species_names = get_species_order(tip_species_counts)
+    clade_counts = get_clade_species_counts(subtree_sizes, tip_species_counts, all_species_names)
+    all_species_counts = clade_counts[0]
+    genomes_in_clades = np.maximum(clade_counts.sum(axis=1), 1)
+
+    best_clades = {}
+    for i, species in enumerate(all_species_names):
+        best_clade = get_best_clade(species, clade_counts[:, i], all_species_counts[i],
+                                    genomes_in_clades)
+        if best_clade is not None:
+            best_clades[species] = best_clade
+    del clade_counts
+
+    species_by_score = get_species_by_score(best_clades, genomes_in_clades)
+    print_species_clades(species_by_score, tip_clusters, cluster_accessions, subtree_sizes)
+    species_colours = {}
+    write_species_trees(tree, subtree_sizes, tip_clusters, tip_species_counts, species_by_score,
+                        species_colours)
+
+    if args.watch:
+        watch_species_definitions(tree, subtree_sizes, tip_clusters, cluster_accessions,
+                                  ncbi_species, accession_species, tip_species_counts,
+                                  genomes_in_clades, best_clades, species_colours)
+
+
+def get_species_counts(accessions, accession_species):
+    return collections.Counter(accession_species[a] for a in accessions)
+
+
+def sort_species_counts(species_counts):
+    """
+    Most common species first, ties broken by name.
+    """
+    return sorted(species_counts.items(), key=lambda x: (1 / x[1], x[0]))
+
+
+def get_species_order(tip_species_counts):
+    """
+    Species are numbered in order of first appearance in the tree, which also decides the output
+    order of species with equal scores.
+    """
+    return list(dict.fromkeys(species for _, species_counts in sorted(tip_species_counts.items())
+                              for species, _ in sort_species_counts(species_counts)))
+
+
+def get_best_clade(species, species_counts_in_clades, species_count_total, genomes_in_clades):
+    """
+    Returns the species' (score, clade) for its best clade, or None if it has no clade.
+    """
+    if species.endswith(' unknown'):
+        return None
+    scores = score_clade_for_species(species_counts_in_clades, species_count_total,
+                                     genomes_in_clades)
+    best = int(np.argmax(scores))  # the first best clade in preorder
+    if scores[best] > 0.0:
+        return float(scores[best]), best
+    return None
+
+
+def get_species_by_score(best_clades, genomes_in_clades):
+    """
+    Returns (species, score, clade) for each species, best first. Ties are broken by the number
+    of genomes in the clade and then stay in species order.
+    """
+    species_by_score = [(species, score, clade) for species, (score, clade) in best_clades.items()]
+    return sorted(species_by_score, reverse=True,
+                  key=lambda x: (x[1], int(genomes_in_clades[x[2]])))
+
+
+def print_species_clades(species_by_score, tip_clusters, cluster_accessions, subtree_sizes):
+    for species, score, clade in species_by_score:
+        accessions = get_clade_accessions(clade, tip_clusters, cluster_accessions, subtree_sizes)
         print()
         print(species)
         print('------------------------------------------------')
         print('score = ' + ('%.4f' % score))
         print(', '.join(accessions))
         print()
-        if score == 1.0:
-            colour_clade_recursively(clade, get_random_colour())
-            if clade.name is None:
-                clade.name = species
 
-    Phylo.write(tree, 'tree_with_species.newick', 'newick')
-    Phylo.write(tree, 'tree_with_species.xml', 'phyloxml')
 
+def write_species_trees(tree, subtree_sizes, tip_clusters, tip_species_counts, species_by_score,
+                        species_colours):
+    """
+    Saves the tree with each tip labelled with its cluster's species and each perfectly-defined
+    species clade coloured and named. The labels go on a copy of the tree, leaving its names
+    untouched for the next write in --watch mode. Each species keeps its colour between writes.
+    """
+    tree = tree._replace(name_ids=tree.name_ids.copy(), names=list(tree.names))
+    for i, cluster_name in tip_clusters.items():
+        formatted_species_counts = ', '.join(str(count) + ' x ' + species for species, count
+                                             in sort_species_counts(tip_species_counts[i]))
+        set_name(tree, i, cluster_name + ' (' + formatted_species_counts + ')')
 
-def load_accession_species():
-    accession_species = {}
+    # Each clade's (red, green, blue) colour, or -1 if uncoloured.
+    colours = np.full((len(tree.parents), 3), -1, dtype=np.int16)
 
-    # Load from NCBI metadata first...
-    data_files = [str(x) for x in pathlib.Path.cwd().glob('assemblies/*/data.tsv')]
-    for data_file in data_files:
-        with open(data_file, 'rt') as data:
-            for line in data:
-                parts = line.split('\t')
-                if parts[0] == 'assembly_accession':
-                    continue
-                accession = parts[0][:13]
-                species = parts[9]
-                species_parts = species.split(' ')[0:2]
-
-                # Some 'species names' aren't really species names.
-                if species_parts[1] == 'sp.':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'bacterium':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'symbiont':
-                    species_parts[1] = 'unknown'
-                elif species_parts[1] == 'endosymbiont':
-                    species_parts[1] = 'unknown'
-
-                species = ' '.join(species_parts)
-                accession_species[accession] = species
-
-    # ...and then load from the user-defined file, so they can overwrite NCBI species.
-    if pathlib.Path('species_definitions').is_file():
-        with open('species_definitions', 'rt') as user_species:
-            user_defined_accessions = set()
-            for line in user_species:
-                if not line.startswith('GCF'):
-                    continue
-                parts = line.strip().split('\t')
-                if parts[0] == 'Accession':
-                    continue
-                if len(parts) < 2:
+    for species, score, clade in species_by_score:
+        if score == 1.0:
+            if species not in species_colours:
+                species_colours[species] = get_random_colour()
+            colours[clade:clade + subtree_sizes[clade]] = species_colours[species]
+            if get_name(tree, clade) is None:
+                set_name(tree, clade, species)
+
+    write_newick(tree, 'tree_with_species.newick')
+    write_phyloxml(tree, 'tree_with_species.xml', colours)
+
+
+def watch_species_definitions(tree, subtree_sizes, tip_clusters, cluster_accessions,
+                              ncbi_species, accession_species, tip_species_counts,
+                              genomes_in_clades, best_clades, species_colours):
+    """
+    Rescores species each time species_definitions changes. Relabelling genomes doesn't change
+    how many genomes are in each clade, so only the species which gained or lost genomes need
+    their clade counts rebuilt, each from just the tips that contain it.
+    """
+    accession_tips = collections.defaultdict(list)
+    for i, cluster_name in tip_clusters.items():
+        for accession in cluster_accessions[cluster_name]:
+            accession_tips[accession].append(i)
+    species_tips = collections.defaultdict(set)
+    for i, species_counts in tip_species_counts.items():
+        for species in species_counts:
+            species_tips[species].add(i)
+
+    print('Watching species_definitions for changes (press Ctrl-C to stop)', file=sys.stderr)
+    last_version = get_file_version('species_definitions')
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            version = get_file_version('species_definitions')
+            if version == last_version:
+                continue
+            last_version = version
+            start_time = time.time()
+
+            # A bad file (e.g. a duplicated accession) is reported without ending the session.
+            try:
+                new_accession_species = apply_species_definitions(ncbi_species)
+            except SystemExit as e:
+                print(e, file=sys.stderr)
+                continue
+            changed_accessions = [a for a in accession_tips
+                                  if new_accession_species[a] != accession_species[a]]
+            changed_species = set(accession_species[a] for a in changed_accessions) | \
+                set(new_accession_species[a] for a in changed_accessions)
+            accession_species = new_accession_species
+
+            changed_tips = set(i for a in changed_accessions for i in accession_tips[a])
+            for i in changed_tips:
+                for species in tip_species_counts[i]:
+                    species_tips[species].discard(i)
+                tip_species_counts[i] = get_species_counts(cluster_accessions[tip_clusters[i]],
+                                                           accession_species)
+                for species in tip_species_counts[i]:
+                    species_tips[species].add(i)
+
+            for species in changed_species:
+                best_clades.pop(species, None)
+                tips = {i: tip_species_counts[i] for i in species_tips[species]}
+                if not tips:
                     continue
-                accession, species = parts[0][:13], parts[1]
-
-                # Don't allow the same accession to be defined twice in the file.
-                if accession in user_defined_accessions:
-                    sys.exit('Error: {} is defined twice'.format(accession))
-
-                if accession in accession_species:
-                    ncbi_species = accession_species
-                    if species == ncbi_species:
-                        print('WARNING: {} has a user-defined species that is the same as the '
-                              'NCBI-defined species'.format(accession))
-
-                accession_species[accession] = species
-                user_defined_accessions.add(accession)
-
-    # If the user-defined file doesn't exist yet, make an empty one with instructions.
-    else:
-        with open('species_definitions', 'wt') as user_species:
-            t = '# This file is where you can define species for particular RefSeq assemblies,\n' \
-                '# overriding the RefSeq species labels. Simply add lines to this file which\n' \
-                '# have the RefSeq assembly accession (starts with GCF) followed by a tab and\n' \
-                '# then the binomial species name. The version number (e.g. final .1) does not\n' \
-                'need to be included in the accession.\n' \
-                '\n' \
-                '# Example:\n' \
-                'GCF_000000000\tGenus species\n'
-            user_species.write(t)
-
-    # Shigella and E. coli are grouped together.
-    for accession, species in accession_species.items():
-        if species == 'Escherichia coli' or species.startswith('Shigella '):
-            accession_species[accession] = 'Escherichia coli / Shigella'
-
-    return accession_species
-
-
-def get_tip_names(clade):
-    tip_names = []
-    if clade.name is not None:
-        tip_names.append(clade.name)
-    for child in clade:
-        tip_names += get_tip_names(child)
-    return tip_names
-
-
-def colour_clade_recursively(clade, colour):
-    clade.color = colour
-    if len(clade) == 0:  # is a tip
-        clade.properties = [Phylo.PhyloXML.Property(colour.to_hex(), 'style:font_color', 'node',
-                                                    'xsd:token')]
-    for child in clade:
-        colour_clade_recursively(child, colour)
-
-
-def get_species_counts_from_tip_names(tip_names):
-    count_texts = []
-    for tip_name in tip_names:
-        assert tip_name.endswith(')')
-        tip_name = tip_name[:-1]
-        tip_name = tip_name.split(' (')[1]
-        count_texts += tip_name.split(', ')
-    counts = collections.defaultdict(int)
-    for count_text in count_texts:
-        parts = count_text.split(' x ')
-        num = int(parts[0])
-        species = parts[1]
-        counts[species] += num
-    return counts
-
-
-def score_clade_for_species(species, clade_species_counts, all_species_counts):
-    species_count_in_clade = clade_species_counts[species]
-    species_count_total = all_species_counts[species]
-    genomes_in_clade = sum(clade_species_counts.values())
-
-    fraction_of_species_in_clade = species_count_in_clade / species_count_total
-    fraction_of_clade_that_is_species = species_count_in_clade / genomes_in_clade
+                species_counts_in_clades = \
+                    get_clade_species_counts(subtree_sizes, tips, [species])[:, 0]
+                best_clade = get_best_clade(species, species_counts_in_clades,
+                                            species_counts_in_clades[0], genomes_in_clades)
+                if best_clade is not None:
+                    best_clades[species] = best_clade
+
+            species_order = get_species_order(tip_species_counts)
+            best_clades = {s: best_clades[s] for s in species_order if s in best_clades}
+            species_by_score = get_species_by_score(best_clades, genomes_in_clades)
+            print('species_definitions changed: {} accession{} relabelled, {} species '
+                  'rescored'.format(len(changed_accessions),
+                                    '' if len(changed_accessions) == 1 else 's',
+                                    len(changed_species)))
+            print_species_clades([x for x in species_by_score if x[0] in changed_species],
+                                 tip_clusters, cluster_accessions, subtree_sizes)
+            write_species_trees(tree, subtree_sizes, tip_clusters, tip_species_counts,
+                                species_by_score, species_colours)
+            print('Updated in {:.2f} s'.format(time.time() - start_time), file=sys.stderr)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print(file=sys.stderr)
+
+
+def get_file_version(filename):
+    try:
+        file_stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def get_clade_accessions(clade, tip_clusters, cluster_accessions, subtree_sizes):
+    """
+    A clade's subtree is a contiguous run of nodes (see phylo_tree), so no traversal is needed.
+    """
+    accessions = []
+    for i in range(clade, clade + subtree_sizes[clade]):
+        if i in tip_clusters:
+            accessions += cluster_accessions[tip_clusters[i]]
+    return accessions
+
+
+def get_clade_species_counts(subtree_sizes, tip_species_counts, species_names):
+    """
+    Returns an array of genome counts with a row for each clade (in preorder) and a column for
+    each of the given species (others are ignored). Each clade's counts are the sum of its
+    subtree's contiguous run of tip rows, taken from running totals of the tip rows in one
+    vectorised step. The totals can't exceed the genome count, so int32 holds them in all but
+    enormous trees.
+    """
+    species_indices = {species: i for i, species in enumerate(species_names)}
+    clade_count = len(subtree_sizes)
+    genome_count = sum(sum(counts.values()) for counts in tip_species_counts.values())
+    dtype = np.int32 if genome_count <= np.iinfo(np.int32).max else np.int64
+    running_totals = np.zeros((clade_count + 1, len(species_names)), dtype=dtype)
+    for i, species_counts in tip_species_counts.items():
+        for species, count in species_counts.items():
+            if species in species_indices:
+                running_totals[i + 1, species_indices[species]] = count
+    np.cumsum(running_totals, axis=0, out=running_totals)
+    starts = np.arange(clade_count)
+    return running_totals[starts + subtree_sizes] - running_totals[starts]
+
+
+def score_clade_for_species(species_counts_in_clades, species_count_total, genomes_in_clades):
+    """
+    Scores every clade at once for one species, from arrays of the species' count and the total
+    genome count in each clade.
+    """
+    fraction_of_species_in_clade = species_counts_in_clades / species_count_total
+    fraction_of_clade_that_is_species = species_counts_in_clades / genomes_in_clades
 
     return fraction_of_species_in_clade * fraction_of_clade_that_is_species
 
@@ -230,7 +317,7 @@ def get_random_colour():
         r, g, b = random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
         h, s, l = rgb_to_hsl(r, g, b)
         if 0.4 < l < 0.9 and s > 0.3:
-            return Phylo.BaseTree.BranchColor(r, g, b)
+            return r, g, b
 
 
 def rgb_to_hsv(r, g, b):
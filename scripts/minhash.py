@@ -0,0 +1,417 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module computes Mash-style MinHash sketches and distances in-process, without running the
+mash tool or parsing its text output. It is not compatible with Mash's own sketch files (it uses
+a different k-mer hash), but it estimates distances in the same way.
+
+A sketch is the bottom-s (smallest s) hashes of an assembly's canonical k-mers, held as a sorted
+uint64 NumPy array. K-mers are 2-bit encoded and hashed with vectorised NumPy operations. Sets of
+sketches are stored in an indexed sketch file (.npz): all hashes concatenated into one uint64
+array, with the offset of each sketch and the name, size and modification time of each file, so
+only new or changed files need to be sketched again.
+
+Distances are computed for blocks of sketches at once: each query sketch is merged with a block
+of reference sketches (padded into a 2D array) in one NumPy sort, and the shared hashes within
+the bottom-s of each union give the Jaccard estimate. Blocks of query sketches are spread over a
+process pool.
+
+For read sets, sketches can instead be screened (like mash screen): a containment index maps each
+reference hash to the references whose sketches contain it, and the reads are streamed once,
+counting only indexed hashes. Each reference's containment (the fraction of its sketch found in
+the reads) then gives an identity estimate without sketching the reads.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import concurrent.futures
+import os
+import pathlib
+import sys
+import numpy as np
+
+from sequence_reader import iterate_sequence_batches
+
+
+# The same defaults as Mash. K-mers are held in 64-bit integers, so the k-mer size can be at
+# most 32.
+DEFAULT_KMER_SIZE = 21
+DEFAULT_SKETCH_SIZE = 10000
+HASH_SEED = 42
+
+# Sketches are padded with this value (larger than any real hash is allowed to be) to make a 2D
+# array. Real hashes equal to it are dropped when sketching.
+PADDING = np.uint64(2 ** 64 - 1)
+
+# Reference sketches are compared to each query in blocks, sized so the merged (block size x
+# 2 * sketch size) array has about this many elements (a few tens of MB).
+MERGE_BLOCK_ELEMENTS = 2 * 1024 * 1024
+
+# Query sketches are handed to the process pool in blocks of this many.
+QUERY_BLOCK_SIZE = 16
+
+# Lookup table from sequence bytes to 2-bit base codes (4 for anything which isn't ACGT).
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b'ACGTacgt', [0, 1, 2, 3, 0, 1, 2, 3]):
+    BASE_CODES[base] = code
+
+# The distinct hashes of a set of sketches (sorted) with, for hash i, the indices of the sketches
+# containing it in references[offsets[i]:offsets[i + 1]], and the number of hashes in each sketch.
+ContainmentIndex = collections.namedtuple('ContainmentIndex', ['hashes', 'offsets', 'references',
+                                                               'sketch_lengths'])
+
+
+def sketch_file(filename, kmer_size=DEFAULT_KMER_SIZE, sketch_size=DEFAULT_SKETCH_SIZE):
+    """
+    Returns the sketch (sorted uint64 array) of a FASTA or FASTQ file (plain or compressed).
+    K-mers are not allowed to span two sequences.
+    """
+    return sketch_sequence_files([filename], kmer_size, sketch_size)
+
+
+def sketch_sequence_files(filenames, kmer_size=DEFAULT_KMER_SIZE,
+                          sketch_size=DEFAULT_SKETCH_SIZE, min_copies=1):
+    """
+    Returns one sketch for all sequences in the files, which are read in batches so large read
+    sets don't need to fit in memory. If min_copies is more than one, only k-mers seen at least
+    that many times are used (like Mash's -m option, to filter out read errors).
+
+    The running sketch keeps every hash below the current cutoff (with its count). The cutoff
+    only goes down, so a hash which ends up in the sketch was kept (and counted) every time it
+    was seen.
+    """
+    sketch = np.zeros(0, dtype=np.uint64)
+    counts = np.zeros(0, dtype=np.int64)
+    for batch in iterate_sequence_batches(filenames):
+        hashes = np.concatenate((sketch, hash_kmers(batch, kmer_size)))
+        if min_copies <= 1:
+            sketch = bottom_hashes(hashes, sketch_size)
+            continue
+        hashes, inverse = np.unique(hashes, return_inverse=True)
+        new_counts = np.bincount(inverse.ravel(), minlength=len(hashes))
+        new_counts[np.searchsorted(hashes, sketch)] += counts - 1
+        solid = np.nonzero(new_counts >= min_copies)[0]
+        if len(solid) >= sketch_size:
+            keep = hashes <= hashes[solid[sketch_size - 1]]
+            sketch, counts = hashes[keep], new_counts[keep]
+        else:
+            sketch, counts = hashes, new_counts
+    if min_copies > 1:
+        sketch = sketch[counts >= min_copies][:sketch_size]
+    return sketch
+
+
+def hash_kmers(sequence, kmer_size):
+    """
+    Returns the hashes of all canonical k-mers in the sequence which contain only ACGT.
+    """
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    kmer_count = len(codes) - kmer_size + 1
+    if kmer_count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # A k-mer is valid if its window contains no non-ACGT bases.
+    invalid_counts = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid_counts[kmer_size:] == invalid_counts[:kmer_count]
+
+    # Forward and reverse complement k-mers are built up two bits at a time, one base position
+    # across all k-mers per step.
+    codes = np.minimum(codes, 3).astype(np.uint64)
+    forward = np.zeros(kmer_count, dtype=np.uint64)
+    reverse = np.zeros(kmer_count, dtype=np.uint64)
+    for i in range(kmer_size):
+        window = codes[i:i + kmer_count]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * i)
+    canonical = np.minimum(forward, reverse)[valid]
+    return mix_hash(canonical ^ np.uint64(HASH_SEED))
+
+
+def mix_hash(values):
+    """
+    MurmurHash3's 64-bit finaliser, which spreads the k-mer bits over the whole hash. It is a
+    bijection, so distinct k-mers never share a hash.
+    """
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def bottom_hashes(hashes, sketch_size):
+    """
+    Returns the smallest sketch_size distinct hashes, sorted. A partial sort is used first, so
+    only the smallest hashes (plus any duplicates of them) are fully sorted.
+    """
+    hashes = hashes[hashes != PADDING]
+    if len(hashes) > 2 * sketch_size:
+        cutoff = np.partition(hashes, 2 * sketch_size)[2 * sketch_size]
+        smallest = np.unique(hashes[hashes <= cutoff])
+        if len(smallest) >= sketch_size:
+            return smallest[:sketch_size]
+    return np.unique(hashes)[:sketch_size]
+
+
+def sketch_files(filenames, kmer_size=DEFAULT_KMER_SIZE, sketch_size=DEFAULT_SKETCH_SIZE,
+                 threads=1):
+    """
+    Sketches the files (in a process pool if threads > 1) and returns a list of sketches in the
+    same order.
+    """
+    jobs = [(f, kmer_size, sketch_size) for f in filenames]
+    if threads > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(sketch_file_job, jobs))
+    return [sketch_file_job(job) for job in jobs]
+
+
+def sketch_file_job(job):
+    return sketch_file(*job)
+
+
+def load_sketch_file(sketch_filename):
+    """
+    Returns a dictionary of name to (file size, modification time, sketch), the k-mer size and
+    the sketch size. A missing file gives an empty dictionary and None for the sizes.
+    """
+    if not pathlib.Path(sketch_filename).is_file():
+        return {}, None, None
+    with np.load(sketch_filename) as sketch_data:
+        names = sketch_data['names'].tolist()
+        file_stats = sketch_data['file_stats']
+        offsets = sketch_data['offsets']
+        hashes = sketch_data['hashes']
+        kmer_size = int(sketch_data['kmer_size'])
+        sketch_size = int(sketch_data['sketch_size'])
+    sketches = {}
+    for i, name in enumerate(names):
+        sketches[name] = (int(file_stats[i, 0]), int(file_stats[i, 1]),
+                          hashes[offsets[i]:offsets[i + 1]])
+    return sketches, kmer_size, sketch_size
+
+
+def save_sketch_file(sketch_filename, sketches, kmer_size, sketch_size):
+    names = sorted(sketches)
+    lengths = [len(sketches[n][2]) for n in names]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    file_stats = np.array([sketches[n][:2] for n in names], dtype=np.int64).reshape(-1, 2)
+    hashes = np.concatenate([sketches[n][2] for n in names]) if names \
+        else np.zeros(0, dtype=np.uint64)
+    temp_filename = sketch_filename + '.tmp.npz'
+    np.savez(temp_filename, names=np.array(names, dtype=str), file_stats=file_stats,
+             offsets=offsets, hashes=hashes, kmer_size=kmer_size, sketch_size=sketch_size)
+    os.replace(temp_filename, sketch_filename)
+
+
+def update_sketch_file(sketch_filename, filenames, kmer_size=DEFAULT_KMER_SIZE,
+                       sketch_size=DEFAULT_SKETCH_SIZE, threads=1, names=None):
+    """
+    Brings the sketch file up to date with the given files (sketching any which are new or have
+    changed since they were sketched) and returns their sketches, in the same order. Sketches are
+    stored by the given names (file basenames by default).
+    """
+    if names is None:
+        names = [os.path.basename(f) for f in filenames]
+    sketches, stored_kmer_size, stored_sketch_size = load_sketch_file(sketch_filename)
+    if stored_kmer_size != kmer_size or stored_sketch_size != sketch_size:
+        sketches = {}
+    to_sketch = []
+    for filename, name in zip(filenames, names):
+        file_stat = os.stat(filename)
+        stored = sketches.get(name)
+        if stored is None or stored[0] != file_stat.st_size or stored[1] != file_stat.st_mtime_ns:
+            to_sketch.append((filename, name, file_stat))
+    if to_sketch:
+        print('Sketching {} assemblies...'.format(len(to_sketch)), end='', flush=True)
+        new_sketches = sketch_files([f for f, _, _ in to_sketch], kmer_size, sketch_size,
+                                    threads)
+        for (filename, name, file_stat), sketch in zip(to_sketch, new_sketches):
+            sketches[name] = (file_stat.st_size, file_stat.st_mtime_ns, sketch)
+        save_sketch_file(sketch_filename, sketches, kmer_size, sketch_size)
+        print(' done', flush=True)
+    return [sketches[name][2] for name in names]
+
+
+def pad_sketches(sketches, sketch_size):
+    padded = np.full((len(sketches), sketch_size), PADDING, dtype=np.uint64)
+    for i, sketch in enumerate(sketches):
+        padded[i, :len(sketch)] = sketch
+    return padded
+
+
+def mash_distances(query, references, kmer_size, sketch_size):
+    """
+    Returns the Mash distances between one padded query sketch and a 2D array of padded
+    reference sketches. Each pair's Jaccard index is estimated from the bottom sketch_size hashes
+    of the union of the two sketches: the fraction of them which are in both sketches.
+    """
+    reference_count = references.shape[0]
+    merged = np.concatenate((np.broadcast_to(query, (reference_count, sketch_size)),
+                             references), axis=1)
+    merged.sort(axis=1, kind='stable')  # merges the two sorted runs in linear time
+    valid = merged != PADDING
+    shared = np.zeros(merged.shape, dtype=bool)
+    shared[:, 1:] = (merged[:, 1:] == merged[:, :-1]) & valid[:, 1:]
+    union_rank = np.cumsum(valid & ~shared, axis=1)
+    shared_count = np.count_nonzero(shared & (union_rank <= sketch_size), axis=1)
+    union_count = np.minimum(union_rank[:, -1], sketch_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = shared_count / union_count
+        distances = -np.log(2.0 * jaccard / (1.0 + jaccard)) / kmer_size
+    distances[~(shared_count > 0)] = 1.0
+    return np.maximum(distances, 0.0)
+
+
+# Process pool workers get the padded sketches once, when they start, rather than with every job.
+worker_sketches = None
+
+
+def init_worker(padded_sketches):
+    global worker_sketches
+    worker_sketches = padded_sketches
+
+
+def distance_rows_job(job):
+    """
+    Returns the distances between the given query sketches and the reference sketches from
+    reference_start onwards (or all references if reference_start is None).
+    """
+    query_start, query_end, reference_start, kmer_size, sketch_size = job
+    padded = worker_sketches
+    rows = []
+    for i in range(query_start, query_end):
+        start = i if reference_start is None else reference_start
+        rows.append(query_distances(padded[i], padded[start:], kmer_size, sketch_size))
+    return query_start, rows
+
+
+def query_distances(query, references, kmer_size, sketch_size):
+    """
+    Returns the float32 Mash distances between one padded query sketch and all of the padded
+    reference sketches, working through the references in blocks.
+    """
+    distances = np.empty(references.shape[0], dtype=np.float32)
+    block_size = max(1, MERGE_BLOCK_ELEMENTS // (2 * sketch_size))
+    for start in range(0, references.shape[0], block_size):
+        end = min(start + block_size, references.shape[0])
+        distances[start:end] = mash_distances(query, references[start:end], kmer_size,
+                                              sketch_size)
+    return distances
+
+
+def iterate_distance_rows(sketches, kmer_size, sketch_size, threads=1, start=0):
+    """
+    Yields (i, distances) for each sketch i from start onwards. Without a start, the distances
+    are to sketches i onwards (the upper triangle of the all-vs-all matrix). With a start, they
+    are to all sketches (so only rows for new sketches at the end of the list are computed).
+    Rows may come out of order when a process pool is used.
+    """
+    padded = pad_sketches(sketches, sketch_size)
+    reference_start = None if start == 0 else 0
+    jobs = [(s, min(s + QUERY_BLOCK_SIZE, len(sketches)), reference_start, kmer_size,
+             sketch_size) for s in range(start, len(sketches), QUERY_BLOCK_SIZE)]
+    if threads > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=init_worker,
+                                                    initargs=(padded,)) as executor:
+            for query_start, rows in executor.map(distance_rows_job, jobs):
+                yield from enumerate(rows, query_start)
+    else:
+        init_worker(padded)
+        for job in jobs:
+            query_start, rows = distance_rows_job(job)
+            yield from enumerate(rows, query_start)
+
+
+def distance_matrix(sketches, kmer_size, sketch_size, threads=1):
+    """
+    Returns the symmetric float32 all-vs-all distance matrix.
+    """
+    count = len(sketches)
+    matrix = np.zeros((count, count), dtype=np.float32)
+    for i, distances in iterate_distance_rows(sketches, kmer_size, sketch_size, threads):
+        matrix[i, i:] = distances
+        matrix[i:, i] = distances
+        if i % 100 == 0:
+            print('.', end='', file=sys.stderr, flush=True)
+    return matrix
+
+
+def close_pairs(sketches, threshold, kmer_size, sketch_size, threads=1, start=0):
+    """
+    Yields (i, j) for each pair of sketches whose distance is below the threshold. If start is
+    given, only pairs involving sketches from start onwards are compared.
+    """
+    for i, distances in iterate_distance_rows(sketches, kmer_size, sketch_size, threads, start):
+        offset = i if start == 0 else 0
+        for j in np.nonzero(distances < threshold)[0].tolist():
+            if j + offset != i:
+                yield i, j + offset
+
+
+def build_containment_index(sketches):
+    """
+    Builds a ContainmentIndex from a list (or padded 2D array) of sketches.
+    """
+    sketch_lengths = np.array([np.count_nonzero(s != PADDING) for s in sketches], dtype=np.int64)
+    all_hashes = np.concatenate([s[:n] for s, n in zip(sketches, sketch_lengths)])
+    owners = np.repeat(np.arange(len(sketch_lengths), dtype=np.int32), sketch_lengths)
+    order = np.argsort(all_hashes, kind='stable')
+    all_hashes, owners = all_hashes[order], owners[order]
+    starts = np.concatenate(([0], np.flatnonzero(all_hashes[1:] != all_hashes[:-1]) + 1))
+    offsets = np.append(starts, len(all_hashes))
+    return ContainmentIndex(all_hashes[starts], offsets, owners, sketch_lengths)
+
+
+def screen_sequence_files(filenames, index, kmer_size, min_copies=1, stop=None):
+    """
+    Streams the sequences in the files once and returns the containment of each indexed sketch:
+    the fraction of its hashes seen in the sequences (at least min_copies times). Only indexed
+    hashes are counted, so memory use doesn't grow with the input. If given, stop is called with
+    the containments after each batch, and reading ends early when it returns True.
+    """
+    min_copies = max(min_copies, 1)
+    counts = np.zeros(len(index.hashes), dtype=np.int32)
+    shared = np.zeros(len(index.sketch_lengths), dtype=np.int64)
+    sketch_lengths = np.maximum(index.sketch_lengths, 1)
+    for batch in iterate_sequence_batches(filenames):
+        hashes = hash_kmers(batch, kmer_size)
+        positions = np.minimum(np.searchsorted(index.hashes, hashes), len(index.hashes) - 1)
+        positions = positions[index.hashes[positions] == hashes]
+        positions, batch_counts = np.unique(positions, return_counts=True)
+        before = counts[positions]
+        counts[positions] = np.minimum(before + batch_counts, min_copies)
+        newly_solid = positions[(before < min_copies) & (before + batch_counts >= min_copies)]
+        shared += np.bincount(get_index_references(index, newly_solid),
+                              minlength=len(shared))
+        if stop is not None and stop(shared / sketch_lengths):
+            break
+    return shared / sketch_lengths
+
+
+def get_index_references(index, positions):
+    """
+    Returns the references of all the given index positions (with repeats), gathered from their
+    ranges of the index without a Python loop.
+    """
+    starts = index.offsets[positions]
+    lengths = index.offsets[positions + 1] - starts
+    range_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return index.references[np.arange(lengths.sum()) + range_starts]
+
+
+def containment_distances(containments, kmer_size):
+    """
+    Converts containments to distances, using mash screen's identity estimate (containment to
+    the power of 1/k).
+    """
+    return 1.0 - np.power(containments, 1.0 / kmer_size)
@@ -5,6 +5,14 @@ https://github.com/rrwick/Bacsort
 
 This script uses FastANI output to generate a PHYLIP distance matrix suitable for quicktree.
 
+A pair's distance is the mean of its two directions (query vs reference and reference vs query)
+if both were computed (run_fastani.py --reciprocal). If only one direction was computed (as
+run_fastani.py does by default), it is used for both.
+
+Pairs without a result are given --max_dist, or left empty (NaN) with --sparse. Use --sparse
+when FastANI was only run for close pairs (run_fastani.py --mash_matrix), so
+combine_distance_matrices.py fills in the missing pairs from the Mash matrix.
+
 This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
 under the terms of the GNU General Public License as published by the Free Software Foundation,
 either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
@@ -15,7 +23,18 @@ not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import os
+import pathlib
 import sys
+import numpy as np
+
+from ani_store import open_ani_store, get_assembly_ids, get_ani_results
+from distance_matrix import save_matrix
+
+
+# Parsed FastANI lines are added to the matrix in batches of this many, so the NumPy calls are
+# few and large.
+BATCH_SIZE = 1000000
 
 
 def get_arguments():
@@ -24,10 +43,21 @@ def get_arguments():
     parser.add_argument('identities', type=str,
                         help='FastANI output file (or similarly formatted file with three '
                              'whitespace-delimited columns of assembly 1, assembly 2, percent '
-                             'identity')
+                             'identity) or a FastANI result store (.db)')
 
     parser.add_argument('--max_dist', type=float, required=False, default=1.0,
                         help='Maximum allowed genomic distance')
+    parser.add_argument('--clusters_dir', type=str, required=False, default='clusters',
+                        help='Directory of cluster assemblies (only used with a FastANI result '
+                             'store)')
+    parser.add_argument('--out', type=str, required=False,
+                        help='Output matrix filename, saved in binary format if it ends in '
+                             '.npy (default: PHYLIP to stdout)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Leave pairs without a result empty (NaN) instead of using '
+                             '--max_dist')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='Gzip the output matrix (default: only if --out ends in .gz)')
 
     args = parser.parse_args()
     return args
@@ -36,58 +66,115 @@ def get_arguments():
 def main():
     args = get_arguments()
 
-    clusters = set()
-    distances = {}
-
     print('', file=sys.stderr)
     print('Convert FastANI distances to PHYLIP matrix', file=sys.stderr)
     print('------------------------------------------------', file=sys.stderr)
 
-    fastani_output_filename = args.identities
-
-    with open(fastani_output_filename, 'rt') as fastani_output:
-        for line in fastani_output:
-            parts = line.strip().split()
-            cluster_1 = parts[0]
-            cluster_2 = parts[1]
-            ani = float(parts[2])
-            if cluster_1 == cluster_2:
-                distance = 0.0
-            else:
-                distance = 1.0 - (ani / 100.0)
-            clusters.add(cluster_1)
-            clusters.add(cluster_2)
-            add_distance(distances, cluster_1, cluster_2, distance)
-            add_distance(distances, cluster_2, cluster_1, distance)
-    print('Found {} clusters and {} distances'.format(len(clusters), len(distances)),
+    if args.identities.endswith('.db'):
+        identities = load_stored_identities(args.identities, args.clusters_dir)
+    else:
+        identities = load_fastani_output(args.identities)
+    clusters, sums, counts = load_pairwise_distances(identities)
+    matrix, distance_count = average_distances(sums, counts, args.max_dist, args.sparse)
+    print('Found {} clusters and {} distances'.format(len(clusters), distance_count),
           file=sys.stderr)
 
-    print(len(clusters))
-    clusters = sorted(clusters)
-    for i in clusters:
-        print(i, end='')
-        for j in clusters:
-            print('\t', end='')
-            try:
-                distance = distances[(i, j)]
-            except KeyError:
-                distance = args.max_dist
-            if distance > args.max_dist:
-                distance = args.max_dist
-            print('%.6f' % distance, end='')
-        print()
-    print('', file=sys.stderr)
+    clusters, matrix = sort_matrix(clusters, matrix)
+    save_matrix(matrix, clusters, args.out, args.gzip)
 
 
-def add_distance(distances, cluster_1, cluster_2, distance):
-    # If this is the first time we've seen this pair, then we just add it to the dictionary.
-    if (cluster_1, cluster_2) not in distances:
-        distances[(cluster_1, cluster_2)] = distance
-    # If we've seen this pair before (the other way around), then we make sure the distances are
-    # close (sanity check) and then save the mean distance.
-    else:
-        assert abs(distance - distances[(cluster_1, cluster_2)]) < 0.1
-        distances[(cluster_1, cluster_2)] = (distances[(cluster_1, cluster_2)] + distance) / 2.0
+def load_fastani_output(fastani_output_filename):
+    with open(fastani_output_filename, 'rt') as fastani_output:
+        for line in fastani_output:
+            parts = line.split()
+            yield parts[0], parts[1], float(parts[2])
+
+
+def load_stored_identities(store_filename, clusters_dir):
+    """
+    Yields the stored FastANI results for the assemblies currently in the clusters directory,
+    named by their filename (as they would be in FastANI output).
+    """
+    cluster_files = sorted(str(x) for x in pathlib.Path(clusters_dir).glob('*.fna.gz'))
+    connection = open_ani_store(store_filename)
+    assembly_ids = get_assembly_ids(connection, cluster_files)
+    assembly_names = {i: os.path.basename(f) for f, i in assembly_ids.items()}
+    yield from get_ani_results(connection, assembly_names)
+
+
+def load_pairwise_distances(identities):
+    """
+    Reads (cluster 1, cluster 2, ANI) tuples in a single pass. Each cluster name is given an
+    integer index the first time it is seen, and distances are accumulated into preallocated
+    sum/count matrices (indexed by query and reference) which grow as needed.
+    """
+    cluster_indices = {}
+    sums = np.zeros((0, 0), dtype=np.float32)
+    counts = np.zeros((0, 0), dtype=np.uint16)
+    batch_i, batch_j, batch_distances = [], [], []
+
+    for cluster_1, cluster_2, ani in identities:
+        i = cluster_indices.setdefault(cluster_1, len(cluster_indices))
+        j = cluster_indices.setdefault(cluster_2, len(cluster_indices))
+        batch_i.append(i)
+        batch_j.append(j)
+        batch_distances.append(0.0 if i == j else 1.0 - (ani / 100.0))
+        if len(batch_i) >= BATCH_SIZE:
+            sums, counts = add_batch(sums, counts, len(cluster_indices),
+                                     batch_i, batch_j, batch_distances)
+            batch_i, batch_j, batch_distances = [], [], []
+    sums, counts = add_batch(sums, counts, len(cluster_indices),
+                             batch_i, batch_j, batch_distances)
+
+    clusters = sorted(cluster_indices, key=cluster_indices.get)
+    cluster_count = len(clusters)
+    return clusters, sums[:cluster_count, :cluster_count], counts[:cluster_count, :cluster_count]
+
+
+def add_batch(sums, counts, cluster_count, batch_i, batch_j, batch_distances):
+    # If there are new clusters, the matrices are enlarged (doubling in size, so this rarely
+    # happens).
+    if cluster_count > sums.shape[0]:
+        capacity = max(cluster_count, 2 * sums.shape[0], 64)
+        old_capacity = sums.shape[0]
+        new_sums = np.zeros((capacity, capacity), dtype=np.float32)
+        new_counts = np.zeros((capacity, capacity), dtype=np.uint16)
+        new_sums[:old_capacity, :old_capacity] = sums
+        new_counts[:old_capacity, :old_capacity] = counts
+        sums, counts = new_sums, new_counts
+    if batch_i:
+        index = (np.array(batch_i), np.array(batch_j))
+        np.add.at(sums, index, np.array(batch_distances, dtype=np.float32))
+        np.add.at(counts, index, 1)
+    return sums, counts
+
+
+def average_distances(sums, counts, max_dist, sparse=False):
+    """
+    Turns the query/reference sums and counts into a symmetric distance matrix. Where both
+    directions of a pair are present, their distances must be close (sanity check) and the mean
+    is used. Where only one is present it is used for both, and where neither is present the
+    distance is max_dist (or NaN if sparse is set).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = sums / counts
+    has_distance = counts > 0
+    both_directions = has_distance & has_distance.T
+    assert np.all(np.abs(matrix - matrix.T)[both_directions] < 0.1)
+
+    matrix = np.where(both_directions, (matrix + matrix.T) / 2.0,
+                      np.where(has_distance, matrix, matrix.T))
+    has_distance |= has_distance.T
+    matrix[~has_distance] = np.nan if sparse else max_dist
+    np.minimum(matrix, max_dist, out=matrix)
+    return matrix, int(np.count_nonzero(has_distance))
+
+
+def sort_matrix(clusters, matrix):
+    order = sorted(range(len(clusters)), key=lambda i: clusters[i])
+    clusters = [clusters[i] for i in order]
+    order = np.array(order, dtype=np.intp)
+    return clusters, matrix[np.ix_(order, order)]
 
 
 if __name__ == '__main__':
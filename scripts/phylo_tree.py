@@ -0,0 +1,413 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module holds phylogenetic trees as flat arrays, which is much faster and lighter than
+BioPython's clade objects for trees with tens of thousands of tips. Nothing here recurses, so
+deep, ladder-like trees are no problem.
+
+Nodes are numbered in preorder with the root first, so the subtree of node i is nodes i to
+i + subtree size - 1. Each node has a parent (-1 for the root), a branch length and confidence
+(NaN if absent) and a name ID: an index into the tree's list of names (-1 if unnamed).
+
+Trees can be read from Newick, rooted at their midpoint and written as Newick or PhyloXML. The
+writers stream to the file, so no document is built in memory.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import math
+import re
+import sys
+import xml.sax.saxutils
+import numpy as np
+
+
+Tree = collections.namedtuple('Tree', ['parents', 'branch_lengths', 'confidences', 'name_ids',
+                                       'names'])
+
+# A Newick token: a quoted label, a comment, punctuation or an unquoted label/number.
+NEWICK_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),;:]|[^\s(),;:\[\]']+")
+
+# Names which don't match this need quoting in Newick (the same rule as BioPython).
+UNQUOTED_LABEL = re.compile(r"[^\s()\[\]':;,]+")
+
+# Output files are written in chunks of about this many characters.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def read_newick(filename):
+    """
+    Reads the first tree in a Newick file. Internal node labels which are numbers are taken as
+    confidences, other labels as names.
+    """
+    with open(filename, 'rt') as newick_file:
+        text = newick_file.read()
+    parents, branch_lengths, labels = [], [], []
+    open_nodes = []   # internal nodes whose closing bracket hasn't been seen yet
+    current = None    # the node which a following label or branch length belongs to
+    after_colon = False
+
+    def add_node():
+        parents.append(open_nodes[-1] if open_nodes else -1)
+        branch_lengths.append(math.nan)
+        labels.append(None)
+        return len(parents) - 1
+
+    for match in NEWICK_TOKEN.finditer(text):
+        token = match.group()
+        if token[0] == '[':
+            continue
+        if token == '(':
+            open_nodes.append(add_node())
+            current = None
+        elif token in (',', ')', ';'):
+            if current is None and token != ';':  # an empty tip, e.g. (,A)
+                add_node()
+            if token == ';':
+                break
+            if token == ')' and not open_nodes:
+                sys.exit('Error: unbalanced brackets in {}'.format(filename))
+            current = open_nodes.pop() if token == ')' else None
+        elif token == ':':
+            if current is None:
+                current = add_node()
+            after_colon = True
+        elif after_colon:
+            try:
+                branch_lengths[current] = float(token)
+            except ValueError:
+                sys.exit('Error: bad branch length in {}: {}'.format(filename, token))
+            after_colon = False
+        else:
+            if current is None:
+                current = add_node()
+            labels[current] = token[1:-1].replace("''", "'") if token[0] == "'" else token
+    if open_nodes or not parents:
+        sys.exit('Error: could not read a tree from {}'.format(filename))
+
+    parents = np.array(parents, dtype=np.int64)
+    has_children = np.zeros(len(parents), dtype=bool)
+    has_children[parents[1:]] = True
+    confidences = np.full(len(parents), math.nan)
+    name_ids = np.full(len(parents), -1, dtype=np.int64)
+    names = []
+    for i, label in enumerate(labels):
+        if label is None:
+            continue
+        if has_children[i]:
+            try:
+                confidences[i] = float(label)
+                continue
+            except ValueError:
+                pass
+        name_ids[i] = len(names)
+        names.append(label)
+    return Tree(parents, np.array(branch_lengths), confidences, name_ids, names)
+
+
+def get_name(tree, node):
+    name_id = tree.name_ids[node]
+    return None if name_id < 0 else tree.names[name_id]
+
+
+def set_name(tree, node, name):
+    if tree.name_ids[node] < 0:
+        tree.name_ids[node] = len(tree.names)
+        tree.names.append(name)
+    else:
+        tree.names[tree.name_ids[node]] = name
+
+
+def get_subtree_sizes(parents):
+    subtree_sizes = np.ones(len(parents), dtype=np.int64)
+    for i in range(len(parents) - 1, 0, -1):  # children before parents
+        subtree_sizes[parents[i]] += subtree_sizes[i]
+    return subtree_sizes
+
+
+def get_children(parents):
+    """
+    Returns a list of each node's children, in order.
+    """
+    children = [[] for _ in range(len(parents))]
+    for i, parent in enumerate(parents[1:].tolist(), 1):
+        children[parent].append(i)
+    return children
+
+
+def root_at_midpoint(tree):
+    """
+    Returns the tree rerooted at the midpoint of the path between its two most distant tips,
+    exactly as BioPython's root_at_midpoint would, including the order of each node's children.
+
+    BioPython reroots the tree at every tip in turn (looking for the most distant pair), and
+    each reroot reverses the path from the old root, which changes the order of children along
+    it. Those reroots are replayed here on plain lists, which only touches the path between one
+    tip and the next (each branch about twice in total). Only the order matters, so the distance
+    from each tip to its farthest node is only calculated in full (in the same way as BioPython,
+    so ties between equal distances are broken the same) for the few tips which might be an end
+    of the longest path. Those are found from every node's farthest distance, calculated for all
+    nodes at once.
+    """
+    children = get_children(tree.parents)
+    parents = tree.parents.tolist()
+    lengths = [None if math.isnan(x) else x for x in tree.branch_lengths.tolist()]
+    tips = [i for i, c in enumerate(children) if not c]
+    if len(tips) < 2:
+        return tree
+    candidates = get_farthest_tip_candidates(children, lengths, tips)
+
+    root = 0
+    max_distance, first_tip, second_tip = 0.0, None, None
+    for tip in tips:
+        root = reroot_with_outgroup(children, parents, lengths, root, tip)
+        if tip in candidates:
+            farthest_node, distance = get_deepest_node(children, lengths, root)
+            if distance > max_distance:
+                max_distance, first_tip, second_tip = distance, tip, farthest_node
+    if first_tip is None:
+        return tree
+    root = reroot_with_outgroup(children, parents, lengths, root, first_tip)
+
+    # Walk from the first tip towards the second tip until half the distance has been covered.
+    root_remainder = 0.5 * (max_distance - (lengths[root] or 0))
+    for node in get_path(parents, root, second_tip):
+        root_remainder -= lengths[node]
+        if root_remainder < 0:
+            root = reroot_with_outgroup(children, parents, lengths, root, node, -root_remainder)
+            break
+    return build_rerooted_tree(tree, children, lengths, root)
+
+
+def get_farthest_tip_candidates(children, lengths, tips):
+    """
+    Returns the set of tips whose distance to their farthest node is within rounding error of
+    the longest. Each node's distance to the farthest node below it and to the farthest node
+    elsewhere is found with one pass up the tree and one pass down, which works for any branch
+    lengths (even negative ones).
+    """
+    lengths = [length or 0.0 for length in lengths]
+    preorder = get_preorder(children, 0)
+    down = [0.0] * len(children)
+    for node in reversed(preorder):
+        for child in children[node]:
+            down[node] = max(down[node], down[child] + lengths[child])
+    up = [-math.inf] * len(children)
+    for node in preorder:
+        # A bifurcating root is removed by the first reroot, so it isn't a node to measure to.
+        itself = -math.inf if node == 0 and len(children[node]) == 2 else 0.0
+        best, second, best_child = -math.inf, -math.inf, None
+        for child in children[node]:
+            distance = down[child] + lengths[child]
+            if distance > best:
+                best, second, best_child = distance, best, child
+            elif distance > second:
+                second = distance
+        for child in children[node]:
+            sibling_distance = second if child == best_child else best
+            up[child] = lengths[child] + max(up[node], itself, sibling_distance)
+    farthest = [max(down[t], up[t]) for t in tips]
+    longest = max(farthest)
+    tolerance = 1e-9 * (sum(abs(x) for x in lengths) + 1.0)
+    return set(t for t, distance in zip(tips, farthest) if distance >= longest - tolerance)
+
+
+def get_preorder(children, root):
+    preorder, stack = [], [root]
+    while stack:
+        node = stack.pop()
+        preorder.append(node)
+        stack += reversed(children[node])
+    return preorder
+
+
+def get_deepest_node(children, lengths, root):
+    """
+    Returns the first node in preorder with the greatest depth (summed from the root in the same
+    order as BioPython's depths) and its depth.
+    """
+    depths = {root: lengths[root] or 0}
+    deepest, max_depth = root, depths[root]
+    for node in get_preorder(children, root):
+        depth = depths[node]
+        if depth > max_depth:
+            deepest, max_depth = node, depth
+        for child in children[node]:
+            depths[child] = depth + (lengths[child] or 0)
+    return deepest, max_depth
+
+
+def get_path(parents, root, target):
+    """
+    Returns the nodes from the root (excluded) to the target (included).
+    """
+    path = []
+    while target != root:
+        path.append(target)
+        target = parents[target]
+    return path[::-1]
+
+
+def reroot_with_outgroup(children, parents, lengths, root, outgroup, outgroup_branch_length=None):
+    """
+    Reroots the tree in place with the outgroup, following BioPython's root_with_outgroup step
+    by step (so children end up in the same order) and returns the new root. For a tip outgroup
+    or a given outgroup branch length, a new root node is added. A bifurcating old root is
+    removed, joining its two branches.
+    """
+    def add_child(node, child, index):
+        children[node].insert(index, child)
+        parents[child] = node
+
+    outgroup_path = get_path(parents, root, outgroup)
+    if not outgroup_path:
+        return root
+    prev_length = lengths[outgroup] or 0.0
+    if not children[outgroup] or outgroup_branch_length is not None:
+        lengths[outgroup] = outgroup_branch_length or 0.0
+        new_root = len(children)
+        children.append([])
+        parents.append(-1)
+        lengths.append(lengths[root])
+        add_child(new_root, outgroup, 0)
+        if len(outgroup_path) == 1:
+            new_parent = new_root
+        else:
+            parent = outgroup_path.pop(-2)
+            children[parent].remove(outgroup)
+            prev_length, lengths[parent] = lengths[parent], prev_length - lengths[outgroup]
+            add_child(new_root, parent, 0)
+            new_parent = parent
+    else:
+        new_root = outgroup
+        lengths[new_root] = lengths[root]
+        new_parent = new_root
+
+    for parent in outgroup_path[-2::-1]:
+        children[parent].remove(new_parent)
+        prev_length, lengths[parent] = lengths[parent], prev_length
+        add_child(new_parent, parent, 0)
+        new_parent = parent
+
+    if outgroup in children[root]:
+        children[root].remove(outgroup)
+    else:
+        children[root].remove(new_parent)
+    if len(children[root]) == 1:
+        ingroup = children[root].pop()
+        lengths[ingroup] = lengths[ingroup] + prev_length if lengths[ingroup] else prev_length
+        add_child(new_parent, ingroup, 0)
+    else:
+        lengths[root] = prev_length
+        add_child(new_parent, root, 0)
+    parents[new_root] = -1
+    return new_root
+
+
+def build_rerooted_tree(tree, children, lengths, root):
+    """
+    Returns a new tree in preorder from the rerooted child lists. Nodes added while rerooting
+    have no name or confidence.
+    """
+    old_nodes = get_preorder(children, root)
+    new_indices = {node: i for i, node in enumerate(old_nodes)}
+    parents = [-1] * len(old_nodes)
+    for node in old_nodes:
+        for child in children[node]:
+            parents[new_indices[child]] = new_indices[node]
+    branch_lengths = [math.nan if lengths[node] is None else lengths[node] for node in old_nodes]
+    old_nodes = np.array(old_nodes, dtype=np.int64)
+    original = old_nodes < len(tree.parents)
+    confidences = np.full(len(old_nodes), math.nan)
+    confidences[original] = tree.confidences[old_nodes[original]]
+    name_ids = np.full(len(old_nodes), -1, dtype=np.int64)
+    name_ids[original] = tree.name_ids[old_nodes[original]]
+    return Tree(np.array(parents, dtype=np.int64), np.array(branch_lengths, dtype=np.float64),
+                confidences, name_ids, list(tree.names))
+
+
+def write_newick(tree, filename):
+    """
+    Writes the tree in the same style as BioPython's Newick writer.
+    """
+    children = get_children(tree.parents)
+    with open(filename, 'wt', buffering=WRITE_BUFFER_SIZE) as newick_file:
+        stack = [0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                newick_file.write(item)
+            elif children[item]:
+                newick_file.write('(')
+                stack.append(')' + get_newick_label(tree, item))
+                for j, child in enumerate(reversed(children[item])):
+                    if j > 0:
+                        stack.append(',')
+                    stack.append(child)
+            else:
+                newick_file.write(get_newick_label(tree, item))
+        newick_file.write(';\n')
+
+
+def get_newick_label(tree, node):
+    label = get_name(tree, node) or ''
+    if label and not UNQUOTED_LABEL.fullmatch(label):
+        label = "'" + label.replace("'", "''") + "'"
+    if not math.isnan(tree.confidences[node]):
+        label += '%1.2f' % tree.confidences[node]
+    branch_length = float(tree.branch_lengths[node])
+    if math.isnan(branch_length) or branch_length == 0.0:  # no length or -0.0
+        branch_length = 0.0
+    return label + ':' + '%1.8g' % branch_length
+
+
+def write_phyloxml(tree, filename, colours=None):
+    """
+    Writes the tree as PhyloXML. If given, colours is an array of (red, green, blue) for each
+    node (-1 for uncoloured nodes): coloured nodes get a branch colour, and coloured tips also
+    get a label colour (for Archaeopteryx). Clades aren't indented by depth, which would make the
+    file quadratic in size for deep trees.
+    """
+    children = get_children(tree.parents)
+    with open(filename, 'wt', buffering=WRITE_BUFFER_SIZE) as xml_file:
+        xml_file.write('<?xml version=\'1.0\' encoding=\'utf-8\'?>\n'
+                       '<phyloxml xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                       'xmlns="http://www.phyloxml.org" xsi:schemaLocation="http://www.phyloxml.'
+                       'org http://www.phyloxml.org/1.10/phyloxml.xsd">\n'
+                       '  <phylogeny rooted="true">\n')
+        stack = [0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                xml_file.write(item)
+                continue
+            xml_file.write('<clade>\n')
+            name = get_name(tree, item)
+            if name is not None:
+                xml_file.write('<name>{}</name>\n'.format(xml.sax.saxutils.escape(name)))
+            if not math.isnan(tree.branch_lengths[item]):
+                xml_file.write('<branch_length>{}</branch_length>\n'.format(
+                    float(tree.branch_lengths[item])))
+            if not math.isnan(tree.confidences[item]):
+                xml_file.write('<confidence type="unknown">{}</confidence>\n'.format(
+                    float(tree.confidences[item])))
+            if colours is not None and colours[item][0] >= 0:
+                red, green, blue = (int(c) for c in colours[item])
+                xml_file.write('<color>\n<red>{}</red>\n<green>{}</green>\n<blue>{}</blue>\n'
+                               '</color>\n'.format(red, green, blue))
+                if not children[item]:
+                    xml_file.write('<property ref="style:font_color" datatype="xsd:token" '
+                                   'applies_to="node">#{:02x}{:02x}{:02x}</property>\n'
+                                   .format(red, green, blue))
+            stack.append('</clade>\n')
+            stack += reversed(children[item])
+        xml_file.write('  </phylogeny>\n'
+                       '</phyloxml>\n')
@@ -15,11 +15,12 @@ not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-import gzip
 import os
 import pathlib
 import sys
 
+from sequence_reader import iterate_records, get_contig_name
+
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Add Bacsort assemblies to Centrifuge database')
@@ -96,16 +97,17 @@ def main():
                     assembly_name = str(assembly).split('/')[-1].replace('.gz', '')
                     new_location = str(library_dir / assembly_name)
                     print('  {} -> {}'.format(assembly, new_location))
-                    with open(new_location, 'wt') as new_fasta:
-                        for contig_name, seq in load_fasta(str(assembly)):
+                    with open(new_location, 'wb') as new_fasta:
+                        for header, seq in iterate_records(str(assembly)):
                             if len(seq) >= args.min_contig_len:
+                                contig_name = get_contig_name(header)
                                 seqid2taxid.write(' '.join([contig_name, str(tax_id)]))
                                 seqid2taxid.write('\n')
-                                new_fasta.write('>')
-                                new_fasta.write(contig_name)
-                                new_fasta.write('\n')
+                                new_fasta.write(b'>')
+                                new_fasta.write(contig_name.encode())
+                                new_fasta.write(b'\n')
                                 new_fasta.write(seq)
-                                new_fasta.write('\n')
+                                new_fasta.write(b'\n')
 
     print('\n\n\nAdding existing Centrifuge seqid2taxid entries')
     print('-------------------------------------------------------------------------------')
@@ -232,70 +234,15 @@ def get_ncbi_name_dicts(names_filename):
     return ids_to_names, names_to_ids
 
 
-def get_compression_type(filename):
-    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
-                  'bz2': (b'\x42', b'\x5a', b'\x68'),
-                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
-    max_len = max(len(x) for x in magic_dict)
-    with open(filename, 'rb') as unknown_file:
-        file_start = unknown_file.read(max_len)
-    compression_type = 'plain'
-    for file_type, magic_bytes in magic_dict.items():
-        if file_start.startswith(magic_bytes):
-            compression_type = file_type
-    if compression_type == 'bz2':
-        sys.exit('Error: cannot use bzip2 format - use gzip instead')
-    if compression_type == 'zip':
-        sys.exit('Error: cannot use zip format - use gzip instead')
-    return compression_type
-
-
-def get_open_function(filename):
-    if get_compression_type(filename) == 'gz':
-        return gzip.open
-    else:  # plain text
-        return open
-
-
 def load_contig_names(filename):
     contig_names = set()
-    open_func = get_open_function(filename)
-    with open_func(filename, 'rt') as fasta_file:
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                contig_name = line[1:].split()[0]
-                if contig_name in contig_names:
-                    sys.exit('Error: duplicate contig names in {}'.format(filename))
-                contig_names.add(contig_name)
+    for header, _ in iterate_records(filename, lengths_only=True):
+        contig_name = get_contig_name(header)
+        if contig_name in contig_names:
+            sys.exit('Error: duplicate contig names in {}'.format(filename))
+        contig_names.add(contig_name)
     return sorted(contig_names)
 
 
-def load_fasta(filename):
-    fasta_seqs = []
-    open_func = get_open_function(filename)
-    with open_func(filename, 'rt') as fasta_file:
-        name = ''
-        sequence = ''
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    contig_name = name.split()[0]
-                    fasta_seqs.append((contig_name, sequence))
-                    sequence = ''
-                name = line[1:]
-            else:
-                sequence += line
-        if name:
-            contig_name = name.split()[0]
-            fasta_seqs.append((contig_name, sequence))
-    return fasta_seqs
-
-
 if __name__ == '__main__':
     main()
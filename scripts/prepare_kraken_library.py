@@ -15,10 +15,10 @@ not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-import gzip
 import os
 import pathlib
-import sys
+
+from sequence_reader import iterate_records, get_contig_name
 
 
 def get_arguments():
@@ -152,18 +152,17 @@ def main():
         new_assembly_filename = 'additional_assemblies/' + assembly_name
         if not new_assembly_filename.endswith('.fna'):
             new_assembly_filename += '.fna'
-        fasta_seqs = load_fasta(assembly)
-        with open(new_assembly_filename, 'wt') as new:
-            for contig_name, seq in fasta_seqs:
+        with open(new_assembly_filename, 'wb') as new:
+            for header, seq in iterate_records(assembly):
                 if len(seq) > args.min_contig_len:
-                    new.write('>')
-                    new.write('kraken:taxid|')
-                    new.write(str(tax_id))
-                    new.write('|')
-                    new.write(contig_name)
-                    new.write('\n')
+                    new.write(b'>')
+                    new.write(b'kraken:taxid|')
+                    new.write(str(tax_id).encode())
+                    new.write(b'|')
+                    new.write(get_contig_name(header).encode())
+                    new.write(b'\n')
                     new.write(seq)
-                    new.write('\n')
+                    new.write(b'\n')
 
 
 def get_taxid(name, names_to_ids, ids_to_nodes, rank):
@@ -244,54 +243,5 @@ def get_ncbi_name_dicts(names_filename):
     return ids_to_names, names_to_ids
 
 
-def get_compression_type(filename):
-    magic_dict = {'gz': (b'\x1f', b'\x8b', b'\x08'),
-                  'bz2': (b'\x42', b'\x5a', b'\x68'),
-                  'zip': (b'\x50', b'\x4b', b'\x03', b'\x04')}
-    max_len = max(len(x) for x in magic_dict)
-    with open(filename, 'rb') as unknown_file:
-        file_start = unknown_file.read(max_len)
-    compression_type = 'plain'
-    for file_type, magic_bytes in magic_dict.items():
-        if file_start.startswith(magic_bytes):
-            compression_type = file_type
-    if compression_type == 'bz2':
-        sys.exit('Error: cannot use bzip2 format - use gzip instead')
-    if compression_type == 'zip':
-        sys.exit('Error: cannot use zip format - use gzip instead')
-    return compression_type
-
-
-def get_open_function(filename):
-    if get_compression_type(filename) == 'gz':
-        return gzip.open
-    else:  # plain text
-        return open
-
-
-def load_fasta(filename):
-    fasta_seqs = []
-    open_func = get_open_function(filename)
-    with open_func(filename, 'rt') as fasta_file:
-        name = ''
-        sequence = ''
-        for line in fasta_file:
-            line = line.strip()
-            if not line:
-                continue
-            if line[0] == '>':  # Header line = start of new contig
-                if name:
-                    contig_name = name.split()[0]
-                    fasta_seqs.append((contig_name, sequence))
-                    sequence = ''
-                name = line[1:]
-            else:
-                sequence += line
-        if name:
-            contig_name = name.split()[0]
-            fasta_seqs.append((contig_name, sequence))
-    return fasta_seqs
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This script runs FastANI between all assembly clusters. Only pairs which aren't already in the
+FastANI result store (tree/fastani.db) are computed. The work is split into blocks which can be
+run by a local pool of worker processes (--backend local), as Slurm array jobs (--backend slurm)
+or with any other job submission command (--backend command). As each block finishes its results
+are added to the store and appended to tree/fastani_output, and failed blocks are retried.
+
+With --mash_matrix, FastANI is only run for pairs of clusters which are close according to Mash
+(below --mash_cutoff). More distant pairs are left out of the results, which
+combine_distance_matrices.py fills in from the Mash matrix.
+
+By default, each pair of clusters is only compared in one direction, which halves the work. Use
+--reciprocal to compare both directions (pairwise_identities_to_distance_matrix.py then averages
+them).
+
+If a run is interrupted, running this script again will resume it, skipping the blocks which
+already finished (use --restart to plan the run again from scratch).
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import pathlib
+import shutil
+import sys
+import numpy as np
+
+from ani_store import open_ani_store, get_assembly_ids, get_incomplete_ids, get_missing_pairs
+from distance_matrix import load_matrix
+from fastani_scheduler import make_block_plan, make_sparse_block_plan, load_block_plan, \
+    run_blocks, merge_block_output, LocalBackend, SlurmBackend, CommandBackend
+
+
+# The Mash matrix is scanned for close pairs in blocks of this many rows.
+ROW_BLOCK_SIZE = 256
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Run FastANI between all clusters')
+
+    parser.add_argument('--backend', type=str, required=False, default='local',
+                        choices=['local', 'slurm', 'command'],
+                        help='How to run the FastANI blocks')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of FastANI processes to run at once (local backend)')
+    parser.add_argument('--groups', type=int, required=False,
+                        help='Number of groups to split the clusters into (each query group is '
+                             'run against each reference group, default: same as --threads for '
+                             'the local backend, 32 otherwise)')
+    parser.add_argument('--slurm_options', type=str, required=False,
+                        default='--ntasks=1 --cpus-per-task=1 --mem=4096 --time=0-24:0:00',
+                        help='Options for sbatch (slurm backend)')
+    parser.add_argument('--slurm_max_array', type=int, required=False, default=1000,
+                        help='Maximum number of tasks in one Slurm array job, which must be less '
+                             'than the cluster\'s MaxArraySize (slurm backend)')
+    parser.add_argument('--submit_command', type=str, required=False,
+                        help='Command to submit one block, with {script} in place of the '
+                             'block\'s script (command backend), e.g. "qsub -cwd {script}"')
+    parser.add_argument('--retries', type=int, required=False, default=2,
+                        help='Number of times to retry a failed block')
+    parser.add_argument('--clusters_dir', type=str, required=False, default='clusters',
+                        help='Directory of cluster assemblies')
+    parser.add_argument('--out', type=str, required=False, default='tree/fastani_output',
+                        help='Merged FastANI output for this run')
+    parser.add_argument('--store', type=str, required=False, default='tree/fastani.db',
+                        help='FastANI result store')
+    parser.add_argument('--work_dir', type=str, required=False, default='tree/fastani_blocks',
+                        help='Directory for the block plan and in-progress block results')
+    parser.add_argument('--reciprocal', action='store_true',
+                        help='Run FastANI in both directions for each pair (default: one '
+                             'direction only)')
+    parser.add_argument('--mash_matrix', type=str, required=False,
+                        help='Mash distance matrix (PHYLIP or .npy) of the clusters - if given, '
+                             'FastANI is only run for pairs which are close according to Mash')
+    parser.add_argument('--mash_cutoff', type=float, required=False, default=0.25,
+                        help='Only run FastANI for pairs with a Mash distance below this (used '
+                             'with --mash_matrix)')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore any interrupted run and plan the blocks again')
+
+    args = parser.parse_args()
+    if args.groups is None:
+        args.groups = args.threads if args.backend == 'local' else 32
+    if args.slurm_max_array < 1:
+        sys.exit('Error: --slurm_max_array must be at least 1')
+    if args.backend == 'command' and args.submit_command is None:
+        sys.exit('Error: --submit_command is required for the command backend')
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    print()
+    print('Find pairwise distances with FastANI')
+    print('------------------------------------------------')
+
+    out_dir = os.path.dirname(args.out)
+    if out_dir and not pathlib.Path(out_dir).is_dir():
+        os.makedirs(out_dir)
+    connection = open_ani_store(args.store)
+    clusters_dir = os.path.abspath(args.clusters_dir)
+
+    saved_plan = None if args.restart else load_block_plan(args.work_dir)
+    if saved_plan is not None:
+        blocks, completed = saved_plan
+        print('Resuming interrupted run: {} of {} blocks already '
+              'complete'.format(len(completed), len(blocks)))
+        blocks = [b for b in blocks if b.name not in completed]
+        output_mode = 'at'
+    else:
+        if args.mash_matrix is None:
+            blocks = plan_blocks(connection, clusters_dir, args.groups, args.work_dir,
+                                 args.reciprocal)
+        else:
+            blocks = plan_sparse_blocks(connection, clusters_dir, args.groups, args.work_dir,
+                                        args.reciprocal, args.mash_matrix, args.mash_cutoff)
+        output_mode = 'wt'
+
+    with open(args.out, output_mode) as merged_output:
+        def finish_block(block):
+            merge_block_output(block, args.work_dir, clusters_dir, merged_output, connection)
+            print('Finished block {}'.format(block.name), flush=True)
+        failed = run_blocks(blocks, get_backend(args), clusters_dir, args.work_dir, finish_block,
+                            args.retries)
+
+    if failed:
+        sys.exit('Error: {} FastANI blocks failed - run this script again to retry '
+                 'them'.format(len(failed)))
+    shutil.rmtree(args.work_dir)
+    print('done')
+    print()
+
+
+def get_backend(args):
+    if args.backend == 'slurm':
+        return SlurmBackend(args.work_dir, args.slurm_options, args.slurm_max_array)
+    elif args.backend == 'command':
+        return CommandBackend(args.submit_command)
+    else:
+        return LocalBackend(args.threads)
+
+
+def plan_blocks(connection, clusters_dir, group_count, work_dir, reciprocal):
+    """
+    Clusters which already have all of their results in the store are 'old' and the rest are
+    'new'. Running new against all, then old against new, computes every missing pair in both
+    directions. Without reciprocal, new against new is only run for the upper block triangle and
+    old against new is skipped, so each missing pair is computed once.
+    """
+    cluster_files = sorted(str(x) for x in pathlib.Path(clusters_dir).glob('*.fna.gz'))
+    assembly_ids = get_assembly_ids(connection, cluster_files)
+    incomplete_ids = get_incomplete_ids(connection, assembly_ids.values(), reciprocal)
+    new_clusters = [f for f in cluster_files if assembly_ids[f] in incomplete_ids]
+    old_clusters = [f for f in cluster_files if assembly_ids[f] not in incomplete_ids]
+    print('{} clusters already have all FastANI results, {} clusters need '
+          'FastANI'.format(len(old_clusters), len(new_clusters)))
+
+    block_sets = []
+    if new_clusters and reciprocal:
+        block_sets.append((new_clusters, cluster_files, group_count, group_count, False))
+    elif new_clusters:
+        block_sets.append((new_clusters, new_clusters, group_count, group_count, True))
+    if new_clusters and old_clusters:
+        if reciprocal:
+            block_sets.append((old_clusters, new_clusters, group_count, group_count, False))
+        else:
+            block_sets.append((new_clusters, old_clusters, group_count, group_count, False))
+    blocks = make_block_plan(work_dir, block_sets)
+    print('Running FastANI in {} blocks'.format(len(blocks)), flush=True)
+    return blocks
+
+
+def plan_sparse_blocks(connection, clusters_dir, group_count, work_dir, reciprocal,
+                       mash_matrix_filename, mash_cutoff):
+    """
+    Plans blocks for only the pairs of clusters which are close in the Mash matrix and don't
+    already have results in the store.
+    """
+    cluster_files = sorted(str(x) for x in pathlib.Path(clusters_dir).glob('*.fna.gz'))
+    assembly_ids = get_assembly_ids(connection, cluster_files)
+    close_pairs = get_close_pairs(cluster_files, mash_matrix_filename, mash_cutoff)
+    id_pairs = [(assembly_ids[a], assembly_ids[b]) for a, b in close_pairs]
+    missing_pairs = set(get_missing_pairs(connection, assembly_ids.values(), id_pairs,
+                                          reciprocal))
+    missing_pairs = [(a, b) for a, b in close_pairs
+                     if (assembly_ids[a], assembly_ids[b]) in missing_pairs]
+    print('{} of {} close pairs (Mash distance < {}) need '
+          'FastANI'.format(len(missing_pairs), len(close_pairs), mash_cutoff))
+    blocks = make_sparse_block_plan(work_dir, cluster_files, group_count, missing_pairs,
+                                    reciprocal)
+    print('Running FastANI in {} blocks'.format(len(blocks)), flush=True)
+    return blocks
+
+
+def get_close_pairs(cluster_files, mash_matrix_filename, mash_cutoff):
+    """
+    Returns (cluster file, cluster file) pairs, including each cluster with itself, whose Mash
+    distance is below the cutoff. Each pair is only given once.
+    """
+    mash_matrix, labels = load_matrix(mash_matrix_filename)
+    label_indices = {label: i for i, label in enumerate(labels)}
+    missing = [f for f in cluster_files if os.path.basename(f) not in label_indices]
+    if missing:
+        sys.exit('Error: {} is not in {}'.format(os.path.basename(missing[0]),
+                                                 mash_matrix_filename))
+    indices = np.array([label_indices[os.path.basename(f)] for f in cluster_files])
+    close_pairs = []
+    for start in range(0, len(cluster_files), ROW_BLOCK_SIZE):
+        end = min(start + ROW_BLOCK_SIZE, len(cluster_files))
+        distances = mash_matrix[np.ix_(indices[start:end], indices[start:])]
+        rows, cols = np.nonzero(np.triu(distances < mash_cutoff))
+        close_pairs += [(cluster_files[start + i], cluster_files[start + j])
+                        for i, j in zip(rows.tolist(), cols.tolist())]
+    return close_pairs
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module reads FASTA and FASTQ files for all of Bacsort's scripts. Files can be plain or
+compressed (gzip, including bgzip, bzip2, xz or zstd), detected from their first bytes.
+
+Files are read in large binary blocks and records are yielded lazily as (header, sequence) bytes,
+so whole assemblies or read sets never need to be held in memory and sequences are built in one
+step rather than line by line. In lengths-only mode, each record's sequence length is counted in
+the block without building the sequence at all.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bz2
+import contextlib
+import gzip
+import io
+import lzma
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Files are read in blocks of this many (decompressed) bytes.
+READ_BLOCK_SIZE = 1024 * 1024
+
+# The first bytes of each supported compression format (bgzip files are gzip files).
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'),
+                     (b'\x28\xb5\x2f\xfd', 'zst'), (b'PK\x03\x04', 'zip')]
+
+# Bytes which are removed from FASTA sequences.
+WHITESPACE = b'\n\r \t'
+
+
+@contextlib.contextmanager
+def open_sequence_file(filename):
+    """
+    Opens a plain, gzip, bzip2, xz or zstd (if the zstandard package is installed) file for
+    reading bytes. The compression is detected by peeking at the start of the file, so it is only
+    opened once. The returned file supports peek, so callers can sniff its contents too.
+    """
+    with open(filename, 'rb') as raw:
+        compression = get_compression_type(raw.peek(8)[:8])
+        if compression == 'gz':
+            f = gzip.GzipFile(fileobj=raw)
+        elif compression == 'bz2':
+            f = bz2.BZ2File(raw)
+        elif compression == 'xz':
+            f = lzma.LZMAFile(raw)
+        elif compression == 'zst':
+            if zstandard is None:
+                sys.exit('Error: the zstandard Python package is needed to read ' + filename)
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+        elif compression == 'zip':
+            sys.exit('Error: cannot use zip format ({}) - use gzip instead'.format(filename))
+        else:
+            f = raw
+        try:
+            yield f
+        finally:
+            if f is not raw:
+                f.close()
+
+
+def get_compression_type(file_start):
+    for magic_bytes, compression in COMPRESSION_MAGIC:
+        if file_start.startswith(magic_bytes):
+            return compression
+    return 'plain'
+
+
+def iterate_records(filename, lengths_only=False):
+    """
+    Yields (header, sequence) for each record in a FASTA or FASTQ file, as bytes. Headers don't
+    include the leading '>' or '@' and sequences have no line breaks or whitespace. With
+    lengths_only, (header, sequence length) is yielded instead.
+    """
+    with open_sequence_file(filename) as f:
+        if f.peek(1)[:1] == b'@':
+            records = iterate_fastq_records(f)
+            if lengths_only:
+                records = ((header, len(sequence)) for header, sequence in records)
+        else:
+            records = iterate_fasta_records(f, lengths_only)
+        yield from records
+
+
+def iterate_fasta_records(f, lengths_only=False):
+    """
+    Records are split at each '>' which starts a line. Complete records are parsed straight from
+    the block buffer and only an unfinished record is carried over to the next block. Anything
+    before the first header is ignored.
+    """
+    buffer = bytearray()
+    search_start = 0
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        buffer += block
+        pos = buffer.find(b'>')
+        if pos == -1:
+            buffer.clear()
+            if not block:
+                return
+            continue
+        while True:
+            next_pos = buffer.find(b'\n>', max(pos, search_start))
+            if next_pos == -1:
+                break
+            yield parse_fasta_record(buffer, pos, next_pos, lengths_only)
+            pos = next_pos + 1
+        if not block:
+            yield parse_fasta_record(buffer, pos, len(buffer), lengths_only)
+            return
+        del buffer[:pos]
+        search_start = max(len(buffer) - 1, 0)
+
+
+def parse_fasta_record(buffer, start, end, lengths_only):
+    header_end = buffer.find(b'\n', start, end)
+    if header_end == -1:
+        header_end = end
+    header = bytes(buffer[start + 1:header_end]).rstrip(b'\r')
+    if lengths_only:
+        sequence_start = min(header_end + 1, end)
+        return header, end - sequence_start - count_whitespace(buffer, sequence_start, end)
+    return header, bytes(buffer[header_end + 1:end]).translate(None, WHITESPACE)
+
+
+def count_whitespace(buffer, start, end):
+    return sum(buffer.count(c, start, end) for c in (b'\n', b'\r', b' ', b'\t'))
+
+
+def iterate_fastq_records(f):
+    """
+    FASTQ records are assumed to be four lines each (unwrapped sequences). Each block is split
+    into lines, with any unfinished line carried over to the next block.
+    """
+    lines, leftover = [], b''
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        new_lines = (leftover + block).split(b'\n')
+        leftover = new_lines.pop() if block else b''
+        lines += new_lines
+        record_end = len(lines) - len(lines) % 4
+        for i in range(0, record_end, 4):
+            yield lines[i][1:].rstrip(b'\r'), lines[i + 1].rstrip(b'\r')
+        del lines[:record_end]
+        if not block:
+            return
+
+
+def get_sequence_lengths(filename):
+    return [length for _, length in iterate_records(filename, lengths_only=True)]
+
+
+def get_contig_name(header):
+    return header.split()[0].decode() if header.strip() else ''
+
+
+def iterate_sequence_batches(filenames, batch_size=8 * 1024 * 1024):
+    """
+    Yields batches of sequence from FASTA or FASTQ files, each holding whole sequences separated
+    by an N so no k-mer spans two sequences.
+    """
+    for filename in filenames:
+        pieces, piece_bytes = [], 0
+        for _, sequence in iterate_records(filename):
+            pieces.append(sequence)
+            pieces.append(b'N')
+            piece_bytes += len(sequence)
+            if piece_bytes >= batch_size:
+                yield b''.join(pieces)
+                pieces, piece_bytes = [], 0
+        if pieces:
+            yield b''.join(pieces)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This script makes a sketch file of assemblies (see minhash.py), which can be used by
+classify_using_mash.py in place of a Mash sketch. Each sketch is named with the assembly's path
+as given, so run it in a directory organised by copy_assemblies.py or copy_clusters.py:
+    sketch_assemblies.py --out sketches.npz */*/*.fna.gz
+
+If the sketch file already exists, only new or changed assemblies are sketched.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import sys
+
+from minhash import update_sketch_file, load_sketch_file, save_sketch_file, DEFAULT_KMER_SIZE
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Sketch assemblies for classification')
+
+    parser.add_argument('assemblies', type=str, nargs='+',
+                        help='Assembly FASTA files')
+    parser.add_argument('--out', type=str, required=True,
+                        help='Sketch file (.npz) to create or update')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of processes to use')
+    parser.add_argument('--kmer', type=int, required=False, default=DEFAULT_KMER_SIZE,
+                        help='K-mer size')
+    parser.add_argument('--sketch_size', type=int, required=False, default=100000,
+                        help='Sketch size')
+
+    args = parser.parse_args()
+    if not args.out.endswith('.npz'):
+        sys.exit('Error: the sketch file name must end in .npz')
+    if not 1 <= args.kmer <= 32:
+        sys.exit('Error: --kmer must be between 1 and 32')
+    return args
+
+
+def main():
+    args = get_arguments()
+    update_sketch_file(args.out, args.assemblies, args.kmer, args.sketch_size, args.threads,
+                       names=args.assemblies)
+
+    # Assemblies which are no longer given are removed from the sketch file.
+    sketches, kmer_size, sketch_size = load_sketch_file(args.out)
+    current = set(args.assemblies)
+    if any(name not in current for name in sketches):
+        sketches = {name: s for name, s in sketches.items() if name in current}
+        save_sketch_file(args.out, sketches, kmer_size, sketch_size)
+    print('{} assemblies in {}'.format(len(sketches), args.out))
+
+
+if __name__ == '__main__':
+    main()
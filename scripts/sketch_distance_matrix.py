@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This script is an alternative to mash_distance_matrix.sh which doesn't need Mash: it sketches
+the clusters and computes their all-vs-all Mash distances in-process, writing the matrix
+directly. Sketches are kept in tree/sketches.npz, so clusters which haven't changed aren't
+sketched again.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import pathlib
+import sys
+
+from distance_matrix import save_matrix
+from minhash import update_sketch_file, distance_matrix, DEFAULT_KMER_SIZE
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Mash distance matrix of all clusters')
+
+    parser.add_argument('--clusters_dir', type=str, required=False, default='clusters',
+                        help='Directory of cluster assemblies')
+    parser.add_argument('--out', type=str, required=False, default='tree/mash.phylip',
+                        help='Output matrix filename, saved in binary format if it ends in .npy')
+    parser.add_argument('--sketches', type=str, required=False, default='tree/sketches.npz',
+                        help='Sketch file (created or updated as needed)')
+    parser.add_argument('--threads', type=int, required=False, default=1,
+                        help='Number of processes to use')
+    parser.add_argument('--kmer', type=int, required=False, default=DEFAULT_KMER_SIZE,
+                        help='K-mer size')
+    parser.add_argument('--sketch_size', type=int, required=False, default=100000,
+                        help='Sketch size')
+
+    args = parser.parse_args()
+    if not 1 <= args.kmer <= 32:
+        sys.exit('Error: --kmer must be between 1 and 32')
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    print()
+    print('Mash distance matrix of all clusters')
+    print('------------------------------------------------')
+
+    for filename in (args.out, args.sketches):
+        out_dir = os.path.dirname(filename)
+        if out_dir and not pathlib.Path(out_dir).is_dir():
+            os.makedirs(out_dir)
+
+    cluster_files = sorted(str(x) for x in pathlib.Path(args.clusters_dir).glob('*.fna.gz'))
+    if not cluster_files:
+        sys.exit('Error: no clusters found in {}'.format(args.clusters_dir))
+    sketches = update_sketch_file(args.sketches, cluster_files, args.kmer, args.sketch_size,
+                                  args.threads)
+
+    print('Finding distances', end='', file=sys.stderr, flush=True)
+    matrix = distance_matrix(sketches, args.kmer, args.sketch_size, args.threads)
+    print(' done', file=sys.stderr, flush=True)
+    save_matrix(matrix, [os.path.basename(f) for f in cluster_files], args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Copyright 2018 Ryan Wick (rrwick@gmail.com)
+https://github.com/rrwick/Bacsort
+
+This module gives Bacsort's scripts the species of each assembly: the NCBI species from the
+assemblies/*/data.tsv metadata files, overridden by the user's species_definitions file.
+
+Parsing every data.tsv file is slow for large downloads, so their contents are kept in an SQLite
+index (assemblies/species_index.db). Each data.tsv file's size and modification time are stored
+with it, and only new or changed files are re-parsed (and rows from removed files dropped) when
+the index is loaded. species_definitions is always read fresh, as it changes often during
+curation.
+
+This file is part of Bacsort. Bacsort is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Bacsort is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Bacsort. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import pathlib
+import sqlite3
+import sys
+
+
+SPECIES_INDEX_FILENAME = 'assemblies/species_index.db'
+
+# Scripts may be run at the same time, so they wait (up to this many seconds) for the database
+# lock instead of failing.
+LOCK_TIMEOUT = 600
+
+# Second words of NCBI organism names which don't make a real species name.
+UNKNOWN_SPECIES_WORDS = {'sp.', 'bacterium', 'symbiont', 'endosymbiont'}
+
+
+def load_accession_species():
+    """
+    Returns a dictionary of accession to species, with the species_definitions applied on top of
+    the NCBI species.
+    """
+    return apply_species_definitions(load_ncbi_species())
+
+
+def load_ncbi_species():
+    """
+    Returns a dictionary of accession to NCBI species (genus and species, with names like
+    'Genus sp. XYZ' given as 'Genus unknown').
+    """
+    return load_index_column('species')
+
+
+def load_ncbi_organism_names():
+    """
+    Returns a dictionary of accession to NCBI organism name, as given in data.tsv (e.g. including
+    strain names).
+    """
+    return load_index_column('organism_names')
+
+
+def load_index_column(column):
+    """
+    Returns a dictionary of accession to the given column for every indexed assembly. If an
+    accession is in more than one data.tsv file, the last file (in path order) wins.
+    """
+    accession_values = {}
+    if not pathlib.Path('assemblies').is_dir():
+        return accession_values
+    connection = open_species_index(SPECIES_INDEX_FILENAME)
+    try:
+        update_species_index(connection)
+        rows = connection.execute('SELECT accessions, {} FROM files ORDER BY path'.format(column))
+        for accessions, values in rows:
+            if accessions:
+                accession_values.update(zip(accessions.split('\n'), values.split('\n')))
+    finally:
+        connection.close()
+    return accession_values
+
+
+def open_species_index(index_filename):
+    """
+    The index has one row per data.tsv file. Its accessions, species and organism names are each
+    stored as one newline-delimited string, which loads far faster than a row per assembly.
+    """
+    connection = sqlite3.connect(index_filename, timeout=LOCK_TIMEOUT)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            accessions TEXT NOT NULL,
+            species TEXT NOT NULL,
+            organism_names TEXT NOT NULL)
+    ''')
+    return connection
+
+
+def update_species_index(connection):
+    """
+    Brings the index up to date with the data.tsv files, re-parsing only those whose size or
+    modification time has changed.
+    """
+    data_files = sorted(str(x) for x in pathlib.Path('assemblies').glob('*/data.tsv'))
+    with connection:
+        stored = {path: (size, mtime) for path, size, mtime
+                  in connection.execute('SELECT path, size, mtime FROM files')}
+        for path in set(stored) - set(data_files):
+            connection.execute('DELETE FROM files WHERE path = ?', (path,))
+        for path in data_files:
+            file_stat = os.stat(path)
+            if stored.get(path) == (file_stat.st_size, file_stat.st_mtime_ns):
+                continue
+            rows = list(parse_data_file(path))
+            columns = ['\n'.join(c) for c in zip(*rows)] if rows else ['', '', '']
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                               [path, file_stat.st_size, file_stat.st_mtime_ns] + columns)
+
+
+def parse_data_file(data_file):
+    """
+    Yields (accession, species, organism name) for each assembly in an NCBI data.tsv file.
+    """
+    with open(data_file, 'rt') as data:
+        for line in data:
+            parts = line.rstrip('\n').split('\t')
+            if parts[0] == 'assembly_accession':
+                continue
+            accession = parts[0][:13]
+            organism_name = parts[9]
+            yield accession, get_species_from_organism_name(organism_name), organism_name
+
+
+def get_species_from_organism_name(organism_name):
+    species_parts = organism_name.split(' ')[0:2]
+
+    # Some 'species names' aren't really species names.
+    if len(species_parts) < 2 or species_parts[1] in UNKNOWN_SPECIES_WORDS:
+        species_parts = [species_parts[0], 'unknown']
+
+    return ' '.join(species_parts)
+
+
+def load_species_definitions():
+    """
+    Returns a dictionary of accession to user-defined species from the species_definitions file
+    (empty if there isn't one).
+    """
+    user_species = {}
+    if not pathlib.Path('species_definitions').is_file():
+        return user_species
+    with open('species_definitions', 'rt') as definitions:
+        for line in definitions:
+            if not line.startswith('GCF'):
+                continue
+            parts = line.strip().split('\t')
+            if parts[0] == 'Accession':
+                continue
+            if len(parts) < 2:
+                continue
+            accession, species = parts[0][:13], parts[1]
+
+            # Don't allow the same accession to be defined twice in the file.
+            if accession in user_species:
+                sys.exit('Error: {} is defined twice'.format(accession))
+
+            user_species[accession] = species
+    return user_species
+
+
+def apply_species_definitions(ncbi_species):
+    """
+    Returns a copy of the NCBI species with the user-defined species applied on top and with
+    Shigella and E. coli grouped together.
+    """
+    accession_species = dict(ncbi_species)
+
+    if pathlib.Path('species_definitions').is_file():
+        for accession, species in load_species_definitions().items():
+            if species == ncbi_species.get(accession):
+                print('WARNING: {} has a user-defined species that is the same as the '
+                      'NCBI-defined species'.format(accession), file=sys.stderr)
+            accession_species[accession] = species
+
+    # If the user-defined file doesn't exist yet, make an empty one with instructions.
+    else:
+        with open('species_definitions', 'wt') as user_species:
+            t = '# This file is where you can define species for particular RefSeq assemblies,\n' \
+                '# overriding the RefSeq species labels. Simply add lines to this file which\n' \
+                '# have the RefSeq assembly accession (starts with GCF) followed by a tab and\n' \
+                '# then the binomial species name. The version number (e.g. final .1) does not\n' \
+                'need to be included in the accession.\n' \
+                '\n' \
+                '# Example:\n' \
+                'GCF_000000000\tGenus species\n'
+            user_species.write(t)
+
+    # Shigella and E. coli are grouped together.
+    for accession, species in accession_species.items():
+        if species == 'Escherichia coli' or species.startswith('Shigella '):
+            accession_species[accession] = 'Escherichia coli / Shigella'
+
+    return accession_species